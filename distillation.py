@@ -0,0 +1,251 @@
+'''
+Distillation of a trained actor into a compact student actor
+'''
+import tensorflow as tf 
+import numpy as np
+import os
+import pandas as pd
+import json
+import time
+try:
+    from utility import Statistics, UtilFuncs
+except ImportError:
+    from AE4350_Assignment.utility import Statistics, UtilFuncs
+try:
+    from evaluation import PolicyAgent, _evaluate_datasets
+except ImportError:
+    from AE4350_Assignment.evaluation import PolicyAgent, _evaluate_datasets
+
+#%% Policy distillation
+class PolicyDistiller:
+    '''
+    Distills the actor of a trained agent (teacher) into a smaller student 
+    actor for serving. The student is trained on the KL divergence between 
+    the action probabilities of the teacher and the student on states from 
+    the replay buffer and from greedy runs of the teacher over price series
+    (optionally followed by rounds on the states visited by the student 
+    itself, labelled by the teacher). The student is an ordinary Actor 
+    with a small model_hyper (student_hyper overrides the teacher's), hence
+    it is exported in the regular checkpoint format (e{episode}/actor_local.h5 
+    and agent_parameters.json) and used through PolicyAgent, take_action and
+    the validation loop as any other actor.
+    '''
+    def __init__(self, teacher, agentParams = None, student_hyper = {}, seed = None):
+        if agentParams is None:
+            agentParams = getattr(teacher, "attr_dct", None)
+        if agentParams is None:
+            raise Exception("The agent parameters of the teacher are required, pass agentParams")
+        if not isinstance(teacher, PolicyAgent):
+            agent = teacher
+            teacher = PolicyAgent(agentParams)
+            teacher.actor_local.model.set_weights(agent.actor_local.model.get_weights())
+        self.teacher = teacher
+        self.teacherParams = agentParams
+        model_hyper = dict(self.teacherParams["model_hyper"])
+        model_hyper.update({"actor_ts_dLayers":[32], "actor_util_dLayers":[], "actor_comb_dLayers":[16],
+                            "use_batchNorm_tsdense":False, "use_dropout_tsdense":False, 
+                            "shared_ts_encoder":False})
+        model_hyper.update(student_hyper)
+        self.studentParams = dict(self.teacherParams, model_hyper = model_hyper)
+        self.student = PolicyAgent(self.studentParams)
+        self.rng = np.random.default_rng(seed)
+        self.history = []
+        self.holdout = None # [states, targets], fixed at the first fit
+        self.train = None # [states, targets], grows with every fit
+        
+    def from_checkpoint(checkpoint_dir: str, episode: int, student_hyper = {}, seed = None):
+        '''
+        Distiller for the actor of a saved checkpoint
+        '''
+        with open(os.path.join(os.getcwd(), checkpoint_dir, 'agent_parameters.json'), 'r') as fp:
+            agentParams = json.load(fp)
+        teacher = PolicyAgent(agentParams)
+        teacher.load_actor(checkpoint_dir, episode)
+        return PolicyDistiller(teacher, agentParams, student_hyper, seed)
+    
+    def rollout_states(self, policy, data: np.array, tanh_scale) -> np.array:
+        '''
+        States visited by the greedy policy on data (with window prefix)
+        '''
+        if isinstance(tanh_scale, str):
+            tanh_scale = self.teacherParams[tanh_scale]
+        window_size = policy.stateTS_size
+        stats = Statistics("", training = False, retain_traces = False)
+        stats.reset_all(policy.n_budget*data[window_size], policy.n_budget*(data[window_size:-1]-data[window_size]))
+        record = {"actions":[], "probs":[], "states":[]}
+        UtilFuncs.evaluate_policy(policy, stats, data, window_size, tanh_scale, 
+                                  extraCash = self.teacherParams.get("VALI_EC",0.), record = record)
+        return np.asarray(record["states"], dtype = np.float32)
+    
+    def collect_states(self, memory = None, datasets = {}, max_buffer = 50000) -> np.array:
+        '''
+        Distillation states from a replay buffer (or a saved Rbuffer.npz) and
+        from greedy runs of the teacher over the data sets {name: [data, tanh_scale]}
+        '''
+        parts = []
+        if memory is not None:
+            if isinstance(memory, str):
+                with np.load(memory) as Rbuffer:
+                    buffer_states = Rbuffer['a'][:min(len(Rbuffer['a']), int(Rbuffer['f']))]
+            else:
+                buffer_states = memory.memory_state[:min(memory.memory_size, memory.memory_counter)]
+            ind = self.rng.choice(len(buffer_states), min(len(buffer_states), max_buffer), replace = False)
+            parts.append(buffer_states[ind].astype(np.float32))
+        for name in datasets:
+            parts.append(self.rollout_states(self.teacher, *datasets[name]))
+        return np.concatenate(parts)
+    
+    def split(self, states: np.array) -> list:
+        W = self.teacher.stateTS_size
+        return [states[:,:W,:], states[:,W:,0]]
+    
+    def get_targets(self, states: np.array, batch_size = 4096) -> np.array:
+        return np.concatenate([self.teacher.predict(*self.split(states[i:i+batch_size])) 
+                               for i in range(0, len(states), batch_size)])
+    
+    @tf.function
+    def _train_step(self, states_ts, states_ut, targets):
+        model = self.student.actor_local.model
+        with tf.GradientTape() as tape:
+            probs = model([states_ts, states_ut], training = True)
+            kl = tf.reduce_sum(targets*(tf.math.log(targets+1e-8)-tf.math.log(probs+1e-8)), axis = 1)
+            loss = tf.reduce_mean(kl)+tf.math.add_n(model.losses+[0.])
+        gradients = tape.gradient(loss, model.trainable_weights)
+        self.optimizer.apply_gradients(zip(gradients, model.trainable_weights))
+        return loss
+    
+    def add_states(self, states: np.array, holdout = 0.1):
+        '''
+        Labels states with the teacher and adds them to the training states. 
+        The first call keeps a holdout fraction apart, the holdout is fixed 
+        afterwards such that the scores of later fits remain comparable
+        '''
+        states = states[self.rng.permutation(len(states))]
+        targets = self.get_targets(states).astype(np.float32)
+        if self.holdout is None:
+            n_holdout = int(holdout*len(states))
+            self.holdout = [states[:n_holdout], targets[:n_holdout]]
+            states, targets = states[n_holdout:], targets[n_holdout:]
+        if self.train is None:
+            self.train = [states, targets]
+        else:
+            self.train = [np.concatenate([self.train[0], states]), np.concatenate([self.train[1], targets])]
+    
+    def fit(self, states = None, epochs = 20, batch_size = 256, learning_rate = 1e-3, 
+            holdout = 0.1, verbose = True) -> pd.DataFrame:
+        '''
+        Adds the (new) states (see add_states) and trains the student on the 
+        teacher probabilities of all training states, the agreement and KL 
+        on the holdout are scored per epoch
+        '''
+        if states is not None:
+            self.add_states(states, holdout)
+        if self.train is None:
+            raise Exception("No distillation states, pass states or call add_states first")
+        if not hasattr(self, "optimizer"):
+            self.optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate)
+        else:
+            self.optimizer.learning_rate = learning_rate
+        train_states, train_targets = self.train
+        for epoch in range(epochs):
+            order = self.rng.permutation(len(train_states))
+            losses = []
+            for i in range(0, len(order), batch_size):
+                ind = order[i:i+batch_size]
+                states_ts, states_ut = self.split(train_states[ind])
+                losses.append(float(self._train_step(tf.constant(states_ts), tf.constant(states_ut), 
+                                                     tf.constant(train_targets[ind]))))
+            row = {"epoch":len(self.history), "loss":np.mean(losses), "n_states":len(train_states)}
+            row.update(self.score_states(*self.holdout))
+            self.history.append(row)
+            if verbose:
+                print("Epoch {0} - KL = {1} | holdout KL = {2} | holdout agreement = {3}".format(
+                      row["epoch"], round(row["loss"],5), round(row["kl"],5), round(row["agreement"],4)))
+        return pd.DataFrame(self.history)
+    
+    def dagger(self, states: np.array, datasets: dict, rounds = 1, **kwargs) -> np.array:
+        '''
+        Alternates fitting with adding the states visited by the greedy 
+        student on the data sets (labelled by the teacher) to the training 
+        states, returns all states (holdout and training)
+        '''
+        self.fit(states, **kwargs)
+        for _ in range(rounds):
+            extra = [self.rollout_states(self.student, *datasets[name]) for name in datasets]
+            self.fit(np.concatenate(extra), **kwargs)
+        return np.concatenate([self.holdout[0], self.train[0]])
+    
+    def score_states(self, states: np.array, targets = None) -> dict:
+        '''
+        Action agreement (argmax) and mean KL divergence of the student w.r.t. the teacher
+        '''
+        if len(states) == 0:
+            return {"agreement":np.nan, "kl":np.nan}
+        if targets is None:
+            targets = self.get_targets(states)
+        probs = self.student.predict(*self.split(states))
+        kl = np.sum(targets*(np.log(targets+1e-8)-np.log(probs+1e-8)), axis = 1)
+        return {"agreement":float(np.mean(np.argmax(probs, axis = 1) == np.argmax(targets, axis = 1))),
+                "kl":float(np.mean(kl))}
+    
+    def report(self, datasets: dict) -> pd.DataFrame:
+        '''
+        Greedy runs of teacher and student over the data sets: profit parity,
+        the agreement of the handled action sequences of both runs and the 
+        state wise agreement and KL on the states visited by the teacher
+        '''
+        rows = []
+        for name in datasets:
+            records = {}
+            teacher = _evaluate_datasets(self.teacher, self.teacherParams, {name: datasets[name]}, 0, records = records)[0]
+            states = self.rollout_states(self.teacher, *datasets[name])
+            student_records = {}
+            student = _evaluate_datasets(self.student, self.studentParams, {name: datasets[name]}, 0, 
+                                         records = student_records)[0]
+            row = {"dataset":name,
+                   "teacher_profit":teacher["profit"], "student_profit":student["profit"],
+                   "profit_gap":student["profit"]-teacher["profit"],
+                   "teacher_trades":teacher["n_trades"], "student_trades":student["n_trades"],
+                   "path_agreement":float(np.mean(np.array(records[name]["actions"]) == 
+                                                  np.array(student_records[name]["actions"])))}
+            row.update({"state_"+key: value for key, value in self.score_states(states).items()})
+            rows.append(row)
+        return pd.DataFrame(rows).set_index("dataset")
+    
+    def benchmark_latency(self, batch_sizes = [1, 256], n_calls = 200) -> pd.DataFrame:
+        '''
+        Mean wall clock time per predict call (as used by take_action) and 
+        the parameter count of teacher and student, the last row holds the 
+        teacher/student ratios
+        '''
+        W, U = self.teacher.stateTS_size, self.teacher.stateUT_size
+        rows = []
+        for name, policy in [["teacher", self.teacher], ["student", self.student]]:
+            row = {"actor":name, "parameters":int(policy.actor_local.model.count_params())}
+            for batch_size in batch_sizes:
+                states_ts = np.zeros((batch_size, W, 1), dtype = np.float32)
+                states_ut = np.zeros((batch_size, U), dtype = np.float32)
+                for _ in range(10): # warmup
+                    policy.predict(states_ts, states_ut)
+                start = time.perf_counter()
+                for _ in range(n_calls):
+                    policy.predict(states_ts, states_ut)
+                row["ms_batch{}".format(batch_size)] = 1e3*(time.perf_counter()-start)/n_calls
+            rows.append(row)
+        table = pd.DataFrame(rows).set_index("actor")
+        return pd.concat([table, (table.loc["teacher"]/table.loc["student"]).to_frame("ratio").T])
+    
+    def export(self, checkpoint_dir: str, episode = 0):
+        '''
+        Saves the student as a regular checkpoint, loadable with 
+        PolicyAgent.load_actor and the CheckpointEvaluator. The folder must
+        not exist yet or be empty
+        '''
+        checkpoint_path = os.path.join(os.getcwd(), checkpoint_dir)
+        if os.path.exists(checkpoint_path) and os.listdir(checkpoint_path):
+            raise Exception("Checkpoint directory already exists and is not empty, please adjust")
+        os.makedirs(os.path.join(checkpoint_path, "e{}".format(episode)))
+        self.student.actor_local.model.save_weights(os.path.join(checkpoint_path, "e{}".format(episode), 'actor_local.h5'))
+        with open(os.path.join(checkpoint_path, 'agent_parameters.json'), 'w') as fp:
+            json.dump(self.studentParams, fp)
+        print("Succesfully exported the student actor to folder {0}, episode {1}".format(checkpoint_dir, episode))
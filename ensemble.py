@@ -0,0 +1,466 @@
+'''
+Stacked ensemble of K agents trained as a single batched model
+'''
+import tensorflow as tf 
+from numpy.random import choice
+import numpy as np
+import os
+import copy 
+import json
+try:
+    from machine_profile import load_machineProfile
+except ImportError:
+    from AE4350_Assignment.machine_profile import load_machineProfile
+try:
+    from utility import Actor, Critic, Agent, UtilFuncs, ReplayBuffer, UpdateScheduler, Statistics
+except ImportError:
+    from AE4350_Assignment.utility import Actor, Critic, Agent, UtilFuncs, ReplayBuffer, UpdateScheduler, Statistics
+try:
+    from evaluation import Portfolio, PolicyAgent
+except ImportError:
+    from AE4350_Assignment.evaluation import Portfolio, PolicyAgent
+
+#%% Stacked ensemble
+class StackedModel:
+    '''
+    K independent copies (members) of a keras template model, i.e. Actor.model
+    or Critic.model, whose weights are stored as stacked tensors with the 
+    member as leading dimension. A forward pass over inputs of shape 
+    (K, batch, ...) therefore evaluates all members with one batched matmul
+    per layer. Supported layers: Input, Flatten, Dense, Dropout, 
+    BatchNormalization and Concatenate. 
+    
+    The variables follow the weight order of the template, get_member thus 
+    returns weights which can be set directly on a normal Actor/Critic model.
+    '''
+    def __init__(self, template, n_members: int):
+        self.n_members = n_members
+        self.input_names = [tensor.name for tensor in template.inputs]
+        self.output_name = template.outputs[0].name
+        self.layers = []
+        self.variables = []
+        self.trainable_variables = []
+        self.regularized = [] # (l2, kernel) pairs
+        for layer in template.layers:
+            inputs = layer.input if isinstance(layer.input, list) else [layer.input]
+            entry = {"layer":layer, 
+                     "inputs":[tensor.name for tensor in inputs], 
+                     "output":layer.output.name,
+                     "variables":[]}
+            if isinstance(layer, tf.keras.layers.Dense):
+                initializers = [[layer.kernel_initializer, True], [layer.bias_initializer, True]]
+            elif isinstance(layer, tf.keras.layers.BatchNormalization):
+                initializers = [[layer.gamma_initializer, True], [layer.beta_initializer, True],
+                                [layer.moving_mean_initializer, False], [layer.moving_variance_initializer, False]]
+            elif isinstance(layer, (tf.keras.layers.InputLayer, tf.keras.layers.Flatten, 
+                                    tf.keras.layers.Dropout, tf.keras.layers.Concatenate)):
+                initializers = []
+            else:
+                raise Exception("Layer {} is not supported by the stacked model".format(type(layer).__name__))
+            
+            for (initializer, trainable), weight in zip(initializers, layer.weights):
+                # every member is initialized independently
+                value = np.stack([initializer(weight.shape, dtype = weight.dtype).numpy() for _ in range(n_members)])
+                variable = tf.Variable(value, trainable = trainable, name = weight.name.split(":")[0])
+                entry["variables"].append(variable)
+                self.variables.append(variable)
+                if trainable:
+                    self.trainable_variables.append(variable)
+            if isinstance(layer, tf.keras.layers.Dense) and layer.kernel_regularizer is not None:
+                self.regularized.append([float(layer.kernel_regularizer.l2), entry["variables"][0]])
+            self.layers.append(entry)
+            
+    def __call__(self, inputs: list, training = False):
+        '''
+        Forward pass of all members, inputs are stacked as (K, batch, ...) in 
+        the input order of the template. Returns the (K, batch, output) outputs
+        '''
+        tensors = dict(zip(self.input_names, inputs))
+        for entry in self.layers:
+            layer = entry["layer"]
+            x = [tensors[name] for name in entry["inputs"]]
+            if isinstance(layer, tf.keras.layers.InputLayer):
+                continue
+            elif isinstance(layer, tf.keras.layers.Flatten):
+                y = tf.reshape(x[0], [tf.shape(x[0])[0], tf.shape(x[0])[1], -1])
+            elif isinstance(layer, tf.keras.layers.Dense):
+                kernel, bias = entry["variables"]
+                y = layer.activation(tf.matmul(x[0], kernel)+bias[:,None,:])
+            elif isinstance(layer, tf.keras.layers.Dropout):
+                y = tf.nn.dropout(x[0], layer.rate) if training else x[0]
+            elif isinstance(layer, tf.keras.layers.BatchNormalization):
+                gamma, beta, moving_mean, moving_variance = entry["variables"]
+                if training:
+                    # statistics per member over the batch dimension
+                    mean, variance = tf.nn.moments(x[0], axes = [1])
+                    moving_mean.assign_sub((moving_mean-mean)*(1-layer.momentum))
+                    moving_variance.assign_sub((moving_variance-variance)*(1-layer.momentum))
+                else:
+                    mean, variance = moving_mean, moving_variance
+                y = tf.nn.batch_normalization(x[0], mean[:,None,:], variance[:,None,:], 
+                                              beta[:,None,:], gamma[:,None,:], layer.epsilon)
+            elif isinstance(layer, tf.keras.layers.Concatenate):
+                y = tf.concat(x, axis = -1)
+            tensors[entry["output"]] = y
+        return tensors[self.output_name]
+    
+    def regularization_losses(self):
+        '''
+        Returns the l2 kernel regularization loss of every member, shape (K,)
+        '''
+        losses = tf.zeros(self.n_members)
+        for l2, kernel in self.regularized:
+            losses += l2*tf.reduce_sum(tf.square(kernel), axis = [1,2])
+        return losses
+    
+    def get_weights(self) -> list:
+        return [variable.numpy() for variable in self.variables]
+    
+    def set_weights(self, weights: list):
+        for variable, value in zip(self.variables, weights):
+            variable.assign(value)
+    
+    def get_member(self, k: int) -> list:
+        '''
+        Returns the weights of member k in the weight order of the template
+        '''
+        return [variable[k].numpy() for variable in self.variables]
+    
+    def set_member(self, k: int, weights: list):
+        for variable, value in zip(self.variables, weights):
+            variable[k].assign(value)
+            
+    def soft_update(self, model_local, tau: float):
+        '''
+        Soft update of this (target) model towards model_local, all members 
+        and all weights (including the batch normalization statistics) at once
+        '''
+        for target, local in zip(self.variables, model_local.variables):
+            target.assign((1-tau)*target+tau*local)
+
+
+class EnsembleMember(Portfolio):
+    '''
+    Portfolio, reward function and replay buffer of a single member of an
+    EnsembleAgent. Members can be used wherever the main notebook uses the
+    agent for the environment, e.g. UtilFuncs.handle_action and get_reward.
+    '''
+    def __init__(self, params: dict, index: int, checkpoint_dir: str, start_price = 0.):
+        Portfolio.__init__(self, params, start_price)
+        self.index = index
+        self.is_eval = False
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_path = os.path.join(os.getcwd(),checkpoint_dir)
+        self.set_rewardtype(self.rewardType)
+        self.memory = ReplayBuffer((self.stateTS_size+self.stateUT_size), self.action_size, self.buffer_size, self.batch_size)
+        self.actor_local_loss = 1.
+        self.last_state = None
+
+
+class EnsembleAgent:
+    '''
+    Trains K independent actor/critic pairs (same model_hyper, different 
+    initialization and exploration) at once. The networks of all members are
+    stored as StackedModels and every learning step is one fused batched step
+    over the K replay streams, i.e. one batch sampled from the buffer of every 
+    member. Each member has its own portfolio, reward function state and 
+    replay buffer (see EnsembleMember) and its checkpoints are stored in the 
+    normal folder format in checkpoint_dir/m{k}, such that every member can be
+    loaded (and evaluated) as a regular run.
+    
+    Notice that every member allocates its own buffer of buffer_size.
+    '''
+    def __init__(self, agentParams, start_price, checkpoint_dir: str, rewardParams: dict, 
+                 extraParams: dict, n_members = 4):
+        self.update_schedule = {} # UpdateScheduler settings, empty means one update every step
+        for key in agentParams:
+            setattr(self, key, agentParams[key])
+        if self.batch_size == "auto":
+            self.batch_size = load_machineProfile().get("batch_size", 128) # see AutoTuner
+            agentParams = dict(agentParams, batch_size = self.batch_size)
+        self.action_size = 2
+        self.n_members = n_members
+        self.attr_dct = {**copy.deepcopy(agentParams), **copy.deepcopy(rewardParams), **copy.deepcopy(extraParams)}
+        self.scheduler = UpdateScheduler(self.batch_size, **self.update_schedule)
+        
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_path = os.path.join(os.getcwd(),self.checkpoint_dir)
+        if os.path.exists(self.checkpoint_path) and len(os.listdir(self.checkpoint_path)) > 0:
+            raise Exception("Checkpoint directory already exists and is not empty, please adjust")
+        os.makedirs(self.checkpoint_path, exist_ok = True)
+        
+        self.members = []
+        for k in range(n_members):
+            member_dir = os.path.join(self.checkpoint_dir, "m{}".format(k))
+            os.makedirs(os.path.join(os.getcwd(),member_dir,"results"))
+            with open('./{0}/agent_parameters.json'.format(member_dir), 'w') as fp:
+                json.dump(self.attr_dct, fp)
+            self.members.append(EnsembleMember(self.attr_dct, k, member_dir, start_price))
+        
+        # templates define the architecture and are used for the export of members
+        sizes = [self.stateTS_size, self.stateUT_size, self.action_size, self.model_hyper]
+        self.actor_template = Actor(*sizes, trainable = False)
+        self.critic_template = Critic(*sizes, trainable = False)
+        self.actor_local = StackedModel(self.actor_template.model, n_members)
+        self.actor_target = StackedModel(self.actor_template.model, n_members)
+        self.critic_local = StackedModel(self.critic_template.model, n_members)
+        self.critic_target = StackedModel(self.critic_template.model, n_members)
+        self.actor_target.set_weights(self.actor_local.get_weights())
+        self.critic_target.set_weights(self.critic_local.get_weights())
+        # same optimizers as the Actor and Critic, adam is elementwise hence the members stay independent
+        self.actor_optimizer = tf.keras.optimizers.Adam(lr=.00001)
+        self.critic_optimizer = tf.keras.optimizers.Adam(lr=0.001)
+        print("Ensemble of {0} members will be saved to {1}".format(n_members, self.checkpoint_path))
+        
+    def reset(self, start_price):
+        for member in self.members:
+            member.reset(start_price)
+    
+    @tf.function
+    def _predict(self, states_ts, states_ut):
+        return self.actor_local([states_ts, states_ut], training = False)
+    
+    def predict(self, states_ts, states_ut) -> np.array:
+        '''
+        Action probabilities of all members for stacked states of shape 
+        (K, batch, stateTS_size, 1) and (K, batch, stateUT_size)
+        '''
+        return self._predict(tf.convert_to_tensor(states_ts, dtype = tf.float32), 
+                             tf.convert_to_tensor(states_ut, dtype = tf.float32)).numpy()
+    
+    def take_actions(self, states: list):
+        '''
+        Ensemble counterpart of Agent.take_action, takes one state per member
+        and returns the actions and action probabilities of every member 
+        '''
+        states = np.stack(states).astype(np.float32)
+        actions_probs = self.predict(states[:,:,:self.stateTS_size,:], states[:,:,-self.stateUT_size:,0])
+        actions = []
+        for k, member in enumerate(self.members):
+            member.last_state = states[k]
+            if not member.is_eval:
+                action = choice(range(self.action_size), p = actions_probs[k,0]/np.sum(actions_probs[k,0])) 
+            else:
+                action = np.argmax(actions_probs[k,0])
+            actions.append(member.map_action(action))
+        return actions, [actions_probs[k] for k in range(self.n_members)]
+    
+    def take_steps(self, actions: list, rewards: list, next_states: list, dones: list, active = None) -> list:
+        '''
+        Ensemble counterpart of Agent.take_step, stores the transition of every
+        (active) member and takes the fused learning steps of the schedule.
+        Returns the actor loss of every member
+        '''
+        if active is None:
+            active = [True]*self.n_members
+        for k, member in enumerate(self.members):
+            if active[k]:
+                member.memory.add_sample(member.last_state, actions[k], rewards[k], next_states[k], dones[k])
+        n_updates, batch_size = self.scheduler.step(min(len(member.memory) for member in self.members))
+        for _ in range(n_updates):
+            self.learn_batch(self.sample_batches(batch_size))
+        self.scheduler.record_updates(n_updates, batch_size)
+        return [member.actor_local_loss for member in self.members]
+    
+    def sample_batches(self, batch_size: int) -> list:
+        '''
+        Samples one batch from the buffer of every member and stacks them
+        '''
+        batches = [member.memory.sample_split(batch_size, self.stateTS_size) for member in self.members]
+        return [np.stack(arrays) for arrays in zip(*batches)]
+    
+    def learn_batch(self, batch):
+        '''
+        Fused learning step of all members, same as Agent.learn_batch but on 
+        stacked batches of shape (K, batch, ...)
+        '''
+        losses = self._learn_batch(*[tf.convert_to_tensor(x) for x in batch])
+        for member, loss in zip(self.members, losses.numpy()):
+            member.actor_local_loss = float(loss)
+    
+    @tf.function
+    def _learn_batch(self, states_ts, states_ut, actions, rewards, next_states_ts, next_states_ut, dones):
+        # critic step, next_states as in Agent.learn_batch
+        next_actions = self.actor_target([states_ts, states_ut], training = False)
+        next_Qtargets = self.critic_target([next_states_ts, next_states_ut, next_actions], training = False)
+        Qtargets = rewards+self.gamma*(1-dones)*next_Qtargets
+        with tf.GradientTape() as tape:
+            Q_values = self.critic_local([states_ts, states_ut, actions], training = True)
+            # mse and regularization per member, summed since the members are independent
+            loss = tf.reduce_mean(tf.square(Qtargets-Q_values), axis = [1,2])+self.critic_local.regularization_losses()
+            loss = tf.reduce_sum(loss)
+        gradients = tape.gradient(loss, self.critic_local.trainable_variables)
+        self.critic_optimizer.apply_gradients(zip(gradients, self.critic_local.trainable_variables))
+        
+        # actor step on the action gradients of the updated critic
+        with tf.GradientTape() as tape:
+            tape.watch(actions)
+            Q_values = self.critic_local([states_ts, states_ut, actions], training = False)
+        actionGradients = tape.gradient(Q_values, actions)
+        with tf.GradientTape() as tape:
+            actions_prob = self.actor_local([states_ts, states_ut], training = True)
+            losses = tf.reduce_mean(-actionGradients*actions_prob, axis = [1,2])
+            loss = tf.reduce_sum(losses)
+        gradients = tape.gradient(loss, self.actor_local.trainable_variables)
+        self.actor_optimizer.apply_gradients(zip(gradients, self.actor_local.trainable_variables))
+        
+        self.actor_target.soft_update(self.actor_local, self.tau)
+        self.critic_target.soft_update(self.critic_local, self.tau)
+        return losses
+    
+    def get_statistics(self, training = True) -> list:
+        '''
+        Returns a Statistics container per member, stored in the member folders
+        '''
+        return [Statistics(member.checkpoint_dir, training = training) for member in self.members]
+    
+    def run_episode(self, data, episode_start: int, episode_end: int, stats: list, 
+                    tanh_scale: float, learn = True, flags = [True, False]):
+        '''
+        Runs all members through one (training) episode in lockstep in the 
+        same manner as the iteration loop of the main notebook. Members that 
+        terminate stop acting while the others continue. The stats must have 
+        been reset (reset_all/reset_episode) beforehand
+        '''
+        window_size = self.stateTS_size
+        l = len(data)-1
+        for member in self.members:
+            member.reset(data[episode_start])
+            member.balance += getattr(member, "EXTRACASH", 0.)
+        for k in range(self.n_members):
+            stats[k].extraCash += getattr(self.members[k], "EXTRACASH", 0.)
+        states = []
+        for k, member in enumerate(self.members):
+            utils_state = [episode_end, stats[k].n_holds, stats[k].n_trades, member.trade_cost, tanh_scale]
+            states.append(UtilFuncs.get_state(member, data, episode_start, window_size + 1, utils_state))
+        active = [True]*self.n_members
+        
+        for t in range(episode_start, episode_end):
+            actions, actions_prob = self.take_actions(states)
+            acting = list(active) # members acting at t, a member terminating at t stores its final transition
+            rewards, next_states, dones = [0.]*self.n_members, list(states), [False]*self.n_members
+            profits = [0.]*self.n_members
+            for k, member in enumerate(self.members):
+                if not active[k]:
+                    continue
+                utils_hdlAct = [actions_prob[k]]
+                actions[k], profits[k], impossible, terminate, term_msg = UtilFuncs.handle_action(member, stats[k], actions[k], data, 
+                                                                                                  t, flags, utils_hdlAct, training = True)
+                dones[k] = terminate or t == episode_end-1
+                utils_reward = [data[t],data[t-1], data[t+1], actions[k], actions_prob[k][0], stats[k].n_trades, 
+                                stats[k].n_holds, impossible, l, terminate]
+                rewards[k] = member.get_reward(member, profits[k], utils_reward, dones[k])
+                stats[k].total_reward += rewards[k]
+                utils_state = [episode_end, stats[k].n_holds, stats[k].n_trades, member.trade_cost, tanh_scale]
+                next_states[k] = UtilFuncs.get_state(member, data, t + 1, window_size + 1, utils_state)
+                if terminate:
+                    active[k] = False
+                    if t >= window_size:
+                        stats[k].pad_on_terminate([l,t])
+                    print("Member {0} was terminated at {1}/{2} due to {3}".format(k, t-window_size, episode_end-episode_start, term_msg))
+            if learn:
+                # the action probabilities are stored as the action, as agent.take_step(action_prob, ...) in the notebook
+                self.take_steps(actions_prob, rewards, next_states, dones, active = acting)
+            for k, member in enumerate(self.members):
+                if active[k]:
+                    utils_saveIter = [profits[k], rewards[k], member.actor_local_loss, actions[k], t-episode_start]
+                    stats[k].collect_iteration(member, utils_saveIter)
+            states = next_states
+            if not any(active):
+                break
+        return stats
+    
+    def save_models(self, episode: int):
+        '''
+        Saves every member in the folder format of Agent.save_models to its
+        own member folder, including its replay buffer
+        '''
+        for k, member in enumerate(self.members):
+            episode_path = os.path.join(member.checkpoint_path,"e{}".format(episode))
+            os.mkdir(episode_path)
+            for name, stacked, template in [["actor_local", self.actor_local, self.actor_template.model],
+                                            ["actor_target", self.actor_target, self.actor_template.model],
+                                            ["critic_local", self.critic_local, self.critic_template.model],
+                                            ["critic_target", self.critic_target, self.critic_template.model]]:
+                template.set_weights(stacked.get_member(k))
+                template.save_weights(os.path.join(episode_path, name+'.h5'))
+            Agent.save_buffer(member)
+        print("Succesfully saved models of {0} members for episode {1}".format(self.n_members, episode))
+    
+    def load_models(self, checkpoint_dir: str, episode: int, buffer = False):
+        '''
+        Loads all members of a saved ensemble, see save_models
+        '''
+        for k, member in enumerate(self.members):
+            episode_path = os.path.join(os.getcwd(), checkpoint_dir, "m{}".format(k), "e{}".format(episode))
+            for name, stacked, template in [["actor_local", self.actor_local, self.actor_template.model],
+                                            ["actor_target", self.actor_target, self.actor_template.model],
+                                            ["critic_local", self.critic_local, self.critic_template.model],
+                                            ["critic_target", self.critic_target, self.critic_template.model]]:
+                template.load_weights(os.path.join(episode_path, name+'.h5'))
+                stacked.set_member(k, template.get_weights())
+            if buffer:
+                buffer_path = os.path.join(os.getcwd(), checkpoint_dir, "m{}".format(k), 'Rbuffer.npz')
+                Agent.load_buffer(member, buffer_path)
+        print("Succesfully loaded {0} members from folder {1} and episode {2}".format(self.n_members, checkpoint_dir, episode))
+    
+    def get_member(self, k: int):
+        '''
+        Returns member k as PolicyAgent, e.g. for UtilFuncs.evaluate_policy
+        '''
+        policy = PolicyAgent(self.attr_dct)
+        policy.actor_local.model.set_weights(self.actor_local.get_member(k))
+        return policy
+    
+    def get_policy(self, mode = "mean"):
+        '''
+        Returns the ensemble as EnsemblePolicy with the current actor weights
+        '''
+        policy = EnsemblePolicy(self.attr_dct, self.n_members, mode = mode)
+        policy.actor_stacked.set_weights(self.actor_local.get_weights())
+        return policy
+
+
+class EnsemblePolicy(PolicyAgent):
+    '''
+    Inference only ensemble, combines the action probabilities of the members 
+    either by their mean ("mean") or by majority vote ("vote", the fraction 
+    of members preferring each action). Being a PolicyAgent it can be used in
+    UtilFuncs.evaluate_policy, the PolicyServer and the BatchBacktester.
+    '''
+    def __init__(self, agentParams: dict, n_members: int, mode = "mean", start_price = 0.):
+        PolicyAgent.__init__(self, agentParams, start_price)
+        if mode not in ["mean", "vote"]:
+            raise Exception("Unknown ensemble mode {}, use mean or vote".format(mode))
+        self.mode = mode
+        self.n_members = n_members
+        self.actor_stacked = StackedModel(self.actor_local.model, n_members)
+        
+    def load_members(self, checkpoint_dir: str, episode: int):
+        '''
+        Loads the actors of all members of an ensemble run (checkpoint_dir/m{k})
+        '''
+        for k in range(self.n_members):
+            self.load_actor(os.path.join(checkpoint_dir, "m{}".format(k)), episode)
+            self.actor_stacked.set_member(k, self.actor_local.model.get_weights())
+    
+    @tf.function
+    def _predict_members(self, states_ts, states_ut):
+        return self.actor_stacked([states_ts, states_ut], training = False)
+    
+    def predict_members(self, states_ts, states_ut) -> np.array:
+        '''
+        Action probabilities of every member for one batch of states, (K, batch, actions)
+        '''
+        states_ts = tf.convert_to_tensor(states_ts, dtype = tf.float32)
+        states_ut = tf.convert_to_tensor(states_ut, dtype = tf.float32)
+        states_ts = tf.tile(states_ts[None], [self.n_members,1,1,1])
+        states_ut = tf.tile(states_ut[None], [self.n_members,1,1])
+        return self._predict_members(states_ts, states_ut).numpy()
+    
+    def predict(self, states_ts, states_ut) -> np.array:
+        actions_probs = self.predict_members(states_ts, states_ut)
+        if self.mode == "mean":
+            return np.mean(actions_probs, axis = 0)
+        votes = np.argmax(actions_probs, axis = -1)
+        return np.stack([np.mean(votes == a, axis = 0) for a in range(self.action_size)], axis = -1)
@@ -0,0 +1,983 @@
+'''
+Inference only agents, (parallel/concurrent/cached) checkpoint evaluation, vectorized 
+backtesting, Monte Carlo stress tests, cost sensitivity and walk-forward retraining
+'''
+import tensorflow as tf 
+from numpy.random import choice
+import numpy as np
+import os
+import pandas as pd
+import plotly.graph_objects as pgo
+from plotly.subplots import make_subplots
+import json
+import re
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import sys
+import hashlib
+import inspect
+try:
+    from machine_profile import load_machineProfile
+except ImportError:
+    from AE4350_Assignment.machine_profile import load_machineProfile
+try:
+    from utility import Agent, TSEncoder, Actor, UtilFuncs, Statistics, OnlineMetrics
+except ImportError:
+    from AE4350_Assignment.utility import Agent, TSEncoder, Actor, UtilFuncs, Statistics, OnlineMetrics
+
+#%% Checkpoint evaluation
+class Portfolio(Agent):
+    '''
+    Portfolio only counterpart of the Agent class, holds the agent attributes 
+    and the portfolio (balance, inventory etc.) without building any models.
+    The portfolio related methods are inherited from Agent.
+    '''
+    def __init__(self, agentParams: dict, start_price = 0.):
+        for key in agentParams:
+            setattr(self, key, agentParams[key])
+            
+        self.action_size = 2
+        self.is_eval = True
+        self.reset(start_price)
+        
+
+class PolicyAgent(Portfolio):
+    '''
+    Inference only counterpart of the Agent class. Only the local actor is 
+    built, i.e. no critics, target networks, optimizers or replay buffer are
+    created, which makes it cheap to construct for the evaluation of saved 
+    checkpoints. 
+    '''
+    def __init__(self, agentParams: dict, start_price = 0.):
+        Portfolio.__init__(self, agentParams, start_price)
+        encoder = TSEncoder(self.stateTS_size, self.model_hyper) if self.model_hyper.get("shared_ts_encoder", False) else None
+        self.actor_local = Actor(self.stateTS_size, self.stateUT_size, 
+                                 self.action_size, self.model_hyper, trainable = False, encoder = encoder)
+    
+    def predict(self, states_ts, states_ut) -> np.array:
+        '''
+        Returns the action probabilities for a batch of states
+        '''
+        return self.actor_local.model([states_ts, states_ut], training = False).numpy()
+    
+    def load_actor(self, checkpoint_dir: str, episode: int):
+        checkpoint_path = os.path.join(os.getcwd(),checkpoint_dir)
+        ckpt_path = os.path.join(checkpoint_path, 'e{}.ckpt.npz'.format(episode))
+        if os.path.isfile(ckpt_path):
+            with np.load(ckpt_path) as ckpt:
+                self.actor_local.model.set_weights(UtilFuncs.read_ckptWeights(ckpt, "actor_local"))
+        else:
+            self.actor_local.model.load_weights(os.path.join(checkpoint_path, 'e{}'.format(episode),'actor_local.h5'))
+        
+    def take_action(self, state, utils: list, use_local = True):
+        '''
+        Same as Agent.take_action but calls the model directly instead of 
+        using predict, which avoids its considerable per call overhead
+        '''
+        states_ts = state[:,:self.stateTS_size,:]
+        states_ut = state[:,-self.stateUT_size:,0]
+        actions_prob = self.predict(states_ts, states_ut)
+        self.last_state = state
+        
+        if not self.is_eval:
+            action = choice(range(self.action_size), p = actions_prob[0]) 
+        else:
+            action = np.argmax(actions_prob[0])
+        action = self.map_action(action)
+        return action, actions_prob
+    
+
+def _init_evalWorker(n_threads: int):
+    '''
+    Process pool initializer, limits the tensorflow threads of each worker 
+    to avoid oversubscription of the cpu when running many workers
+    '''
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    
+
+def _evaluate_checkpoint(job):
+    '''
+    Process pool worker, evaluates a single checkpoint on all data sets.
+    Defined at module level such that it can be pickled.
+    '''
+    checkpoint_path, episode, agentParams, datasets, cache = job
+    agent = PolicyAgent(agentParams)
+    agent.load_actor(checkpoint_path, episode)
+    if cache is not None:
+        return EvaluationCache(*cache).evaluate(agent, agentParams, datasets, episode, checkpoint_path)
+    return _evaluate_datasets(agent, agentParams, datasets, episode, checkpoint_path)
+
+
+def _evaluate_datasets(agent, agentParams: dict, datasets: dict, episode: int, checkpoint_path = "", 
+                       records = None) -> list:
+    '''
+    Greedy evaluation of a PolicyAgent on all data sets, one result row per
+    data set. If records is a dictionary the actions and probabilities of 
+    every data set are stored in it (see UtilFuncs.evaluate_policy)
+    '''
+    window_size = agent.stateTS_size
+    extraCash = agentParams.get("VALI_EC",0.)
+    
+    rows = []
+    for name in datasets:
+        data, tanh_scale = datasets[name]
+        if isinstance(tanh_scale, str):
+            tanh_scale = agentParams[tanh_scale] # e.g. "vali_tanh"
+        stats = Statistics(checkpoint_path, training = False, retain_traces = False)
+        growth_buyhold = agent.n_budget*(data[window_size:-1]-data[window_size])
+        stats.reset_all(agent.n_budget*data[window_size], growth_buyhold)
+        record = None
+        if records is not None:
+            record = records[name] = {"actions":[], "probs":[]}
+        UtilFuncs.evaluate_policy(agent, stats, data, window_size, tanh_scale, extraCash = extraCash,
+                                  record = record)
+        metrics = stats.get_metrics()
+        rows.append({"episode":episode,
+                     "dataset":name,
+                     "profit":stats.growth[-1],
+                     "profit_buyhold":stats.growth_buyhold[-1],
+                     "profit_diff":stats.compete[-1],
+                     "n_trades":stats.n_trades,
+                     "n_posiProfits":stats.n_posiProfits,
+                     "n_impossible":stats.n_impossible,
+                     "extraCash":stats.extraCash,
+                     "sharpe":metrics["sharpe"],
+                     "max_drawdown":metrics["max_drawdown"]})
+    return rows
+    
+
+class CheckpointEvaluator:
+    '''
+    Evaluates every saved checkpoint (e{episode} folder) of a run on one or
+    more data sets using the greedy policy. Checkpoints are distributed over
+    a process pool and every worker only loads the actor weights.
+    
+    The data sets are given as a dictionary of name -> [data, tanh_scale], 
+    where the data must contain the window prefix (as done for data_val in 
+    the main notebook) and the tanh_scale can either be a number or the name 
+    of the agent attribute, e.g.:
+        {"validation": [data_val, "vali_tanh"], "test": [data_test, "test_tanh"]}
+    
+    With a cache_dir the results are memoized in an EvaluationCache, 
+    checkpoints that were evaluated before on the same data are not rerun.
+    '''
+    def __init__(self, checkpoint_dir: str, datasets: dict, n_workers = None, threads_per_worker = 1,
+                 cache_dir = None, cache_bytes = 500e6):
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_path = os.path.join(os.getcwd(),checkpoint_dir)
+        self.datasets = datasets
+        if n_workers is None:
+            n_workers = max(1,os.cpu_count()//threads_per_worker)
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.cache = None if cache_dir is None else (cache_dir, cache_bytes)
+        with open(os.path.join(self.checkpoint_path,'agent_parameters.json'), 'r') as fp:
+            self.agentParams = json.load(fp)
+    
+    def find_checkpoints(self) -> list:
+        '''
+        Returns the sorted episodes of all checkpoints in the run folder, 
+        both the folder and the single file format are considered
+        '''
+        episodes = []
+        for name in os.listdir(self.checkpoint_path):
+            if re.fullmatch(r"e\d+", name) and \
+               os.path.isfile(os.path.join(self.checkpoint_path, name, 'actor_local.h5')):
+                episodes.append(int(name[1:]))
+            elif re.fullmatch(r"e\d+\.ckpt\.npz", name):
+                episodes.append(int(name[1:-len(".ckpt.npz")]))
+        return sorted(set(episodes))
+    
+    def evaluate(self, episodes = None) -> pd.DataFrame:
+        '''
+        Evaluates the given (default all) checkpoints and returns a single 
+        results table with one row per checkpoint and data set
+        '''
+        if episodes is None:
+            episodes = self.find_checkpoints()
+        jobs = [(self.checkpoint_path, e, self.agentParams, self.datasets, self.cache) for e in episodes]
+        
+        if self.n_workers <= 1 or len(jobs) <= 1:
+            results = list(map(_evaluate_checkpoint, jobs))
+        else:
+            # spawn instead of fork since tensorflow is not fork safe
+            ctx = multiprocessing.get_context("spawn") 
+            with ProcessPoolExecutor(max_workers = min(self.n_workers,len(jobs)), mp_context = ctx,
+                                     initializer = _init_evalWorker, 
+                                     initargs = (self.threads_per_worker,)) as pool:
+                results = list(pool.map(_evaluate_checkpoint, jobs))
+                
+        table = pd.DataFrame([row for rows in results for row in rows])
+        if len(table):
+            table = table.sort_values(["dataset","episode"]).reset_index(drop = True)
+        print("Succesfully evaluated {0} checkpoints of folder {1} on {2} data sets".format(len(jobs),
+                                                                                         self.checkpoint_dir,
+                                                                                         len(self.datasets)))
+        return table
+
+
+#%% Concurrent validation
+_snapshot_policy = None # PolicyAgent of a validation worker, built once per process
+
+def _validate_snapshot(job):
+    '''
+    Process pool worker, scores one actor weight snapshot on all data sets
+    '''
+    global _snapshot_policy
+    episode, weights, agentParams, datasets = job
+    if _snapshot_policy is None:
+        _snapshot_policy = PolicyAgent(agentParams)
+    _snapshot_policy.actor_local.model.set_weights(weights)
+    return _evaluate_datasets(_snapshot_policy, agentParams, datasets, episode)
+
+
+class SnapshotValidator:
+    '''
+    Validates actor weight snapshots in a separate process while training
+    continues. The learner publishes a snapshot (publish), the worker scores
+    it with the greedy policy on the data sets (same format and results as 
+    CheckpointEvaluator) and poll hands the finished results back, in the 
+    order of publishing, into the history dictionary and the Statistics of 
+    the data sets (validation_dct). The validation metric of dataset (default
+    the first data set) drives an early stopping signal: should_stop is set 
+    after patience results without an improvement of at least min_delta.
+    
+    usage:
+        validator = SnapshotValidator(agent.attr_dct, {"validation": [data_val, "vali_tanh"]}, patience = 10)
+        ...
+        if e % saveIter == 0:
+            validator.publish(e, agent)
+        validator.poll(history, {"validation": stats_val})
+        if validator.should_stop:
+            break
+        ...
+        validator.close(history, {"validation": stats_val})
+    
+    At most max_pending snapshots are queued, further snapshots are skipped
+    (and reported as such) until the worker has caught up, such that the 
+    learner never waits for the validation.
+    '''
+    def __init__(self, agentParams: dict, datasets: dict, metric = "profit_diff", dataset = None, 
+                 patience = 0, min_delta = 0., max_pending = 2, threads_per_worker = 1):
+        self.agentParams = agentParams
+        self.datasets = datasets
+        self.metric = metric
+        self.dataset = list(datasets)[0] if dataset is None else dataset
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_pending = max_pending
+        self.threads_per_worker = threads_per_worker
+        self.executor = None
+        self.pending = [] # [episode, future] in the order of publishing
+        self.results = []
+        self.skipped = []
+        self.best_value = -np.inf
+        self.best_episode = None
+        self.n_bad = 0
+        self.should_stop = False
+    
+    def start(self):
+        if self.executor is None:
+            ctx = multiprocessing.get_context("spawn") # tensorflow is not fork safe
+            self.executor = ProcessPoolExecutor(max_workers = 1, mp_context = ctx, 
+                                                initializer = _init_evalWorker, 
+                                                initargs = (self.threads_per_worker,))
+        return self
+    
+    def publish(self, episode: int, agent) -> bool:
+        '''
+        Submits the current local actor weights of the agent, returns False 
+        if the snapshot was skipped since the worker is behind
+        '''
+        self.start()
+        if len([1 for _, future in self.pending if not future.done()]) >= self.max_pending:
+            self.skipped.append(episode)
+            print("E{0} - Validation is behind, snapshot skipped".format(episode))
+            return False
+        weights = agent.actor_local.model.get_weights()
+        job = (episode, weights, self.agentParams, self.datasets)
+        self.pending.append([episode, self.executor.submit(_validate_snapshot, job)])
+        return True
+    
+    def collect(self, rows: list, history = None, stats = None):
+        '''
+        Stores the results of one snapshot, updates history, Statistics and 
+        the early stopping state
+        '''
+        self.results.extend(rows)
+        for row in rows:
+            name = row["dataset"]
+            if history is not None:
+                history.setdefault(name+"_episode", []).append(row["episode"])
+                history.setdefault(name+"_profit", []).append(row["profit"])
+                history.setdefault(name+"_pratio", []).append(row["n_posiProfits"]/max(1,row["n_trades"]))
+                history.setdefault(name+"_extraCash", []).append(row["extraCash"])
+            if stats is not None and name in stats:
+                stats[name].validation_dct["e{}".format(row["episode"])] = row
+            if name == self.dataset:
+                value = row[self.metric]
+                if value > self.best_value+self.min_delta:
+                    self.best_value, self.best_episode, self.n_bad = value, row["episode"], 0
+                else:
+                    self.n_bad += 1
+                self.should_stop = self.patience > 0 and self.n_bad >= self.patience
+                print("E{0} - Validation {1} = {2} | best = {3} (E{4}){5}".format(row["episode"], self.metric, 
+                      round(value,2), round(self.best_value,2), self.best_episode, 
+                      " | early stopping" if self.should_stop else ""))
+    
+    def poll(self, history = None, stats = None) -> list:
+        '''
+        Collects the finished results without blocking, returns the new rows
+        '''
+        new_rows = []
+        while self.pending and self.pending[0][1].done():
+            _, future = self.pending.pop(0)
+            rows = future.result()
+            self.collect(rows, history, stats)
+            new_rows.extend(rows)
+        return new_rows
+    
+    def wait(self, history = None, stats = None) -> list:
+        '''
+        Blocks until all published snapshots are scored
+        '''
+        new_rows = []
+        while self.pending:
+            _, future = self.pending.pop(0)
+            rows = future.result()
+            self.collect(rows, history, stats)
+            new_rows.extend(rows)
+        return new_rows
+    
+    def get_results(self) -> pd.DataFrame:
+        return pd.DataFrame(self.results)
+    
+    def close(self, history = None, stats = None):
+        if self.executor is not None:
+            try:
+                self.wait(history, stats)
+            finally:
+                self.executor.shutdown()
+                self.executor = None
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+class EvaluationCache:
+    '''
+    Disk cache of greedy policy evaluations. An entry is keyed by a hash of
+    the actor weights, the data set content, the tanh scale, the cost and 
+    state settings of the agent and the source code of the evaluation path,
+    hence changing any of them results in a new evaluation. Every entry 
+    (one .npz file) holds the action sequence, the action probabilities and
+    the result row of the data set. The least recently used entries are 
+    removed once the cache exceeds max_bytes.
+    '''
+    _code_version = None
+    
+    def __init__(self, cache_dir: str, max_bytes = 500e6):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok = True)
+    
+    def get_codeVersion() -> str:
+        '''
+        Hash of the source code which determines the evaluation results
+        '''
+        if EvaluationCache._code_version is None:
+            parts = [UtilFuncs.evaluate_policy, UtilFuncs.get_state, UtilFuncs.handle_action, 
+                     UtilFuncs.get_utilState, Agent.reset, Agent.map_action, PolicyAgent.take_action, 
+                     Actor, TSEncoder, Statistics.collect_iteration, OnlineMetrics, _evaluate_datasets]
+            try:
+                source = "".join(inspect.getsource(part) for part in parts)
+            except (OSError, TypeError):
+                source = ""
+                for path in [sys.modules[Agent.__module__].__file__, __file__]:
+                    with open(path, "r") as fp:
+                        source += fp.read()
+            EvaluationCache._code_version = hashlib.sha1(source.encode()).hexdigest()
+        return EvaluationCache._code_version
+    
+    def get_key(self, weights: list, data: np.array, tanh_scale: float, agentParams: dict) -> str:
+        settings = {key: agentParams.get(key) for key in ["trade_cost", "TRADECOST_ACTUAL", "VALI_EC", 
+                                                           "n_budget", "max_holds", "stateTS_size", 
+                                                           "stateUT_size", "model_hyper"]}
+        digest = hashlib.sha1()
+        digest.update(EvaluationCache.get_codeVersion().encode())
+        digest.update(json.dumps(settings, sort_keys = True).encode())
+        digest.update(np.float64(tanh_scale).tobytes())
+        digest.update(np.ascontiguousarray(data, dtype = np.float64).tobytes())
+        for w in weights:
+            digest.update(str(w.shape).encode())
+            digest.update(np.ascontiguousarray(w).tobytes())
+        return digest.hexdigest()
+    
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key+".npz")
+    
+    def get(self, key: str):
+        '''
+        Returns the cached entry {"actions", "probs", "row"} or None
+        '''
+        path = self.get_path(key)
+        try:
+            with np.load(path) as entry:
+                result = {"actions":entry["actions"], "probs":entry["probs"], 
+                          "row":json.loads(str(entry["row"]))}
+            os.utime(path) # most recently used
+        except (OSError, KeyError, ValueError):
+            return None
+        return result
+    
+    def put(self, key: str, actions: list, probs: list, row: dict):
+        path = self.get_path(key)
+        tmp_path = path[:-len(".npz")]+".{}.tmp.npz".format(os.getpid())
+        np.savez_compressed(tmp_path, actions = np.asarray(actions, dtype = np.int8),
+                            probs = np.asarray(probs, dtype = np.float32),
+                            row = np.array(json.dumps(row)))
+        os.replace(tmp_path, path) # concurrent workers never see half written entries
+        self.evict()
+    
+    def evict(self) -> int:
+        '''
+        Removes the least recently used entries until the cache fits in 
+        max_bytes, returns the number of removed entries
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                try:
+                    info = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append([info.st_mtime, info.st_size, name])
+        total = sum(entry[1] for entry in entries)
+        n_removed = 0
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            n_removed += 1
+        return n_removed
+    
+    def evaluate(self, policy, agentParams: dict, datasets: dict, episode: int, checkpoint_path = "") -> list:
+        '''
+        Same as _evaluate_datasets, but every data set is only evaluated if 
+        it is not in the cache yet. The rows carry a cached flag
+        '''
+        weights = policy.actor_local.model.get_weights()
+        rows = []
+        for name in datasets:
+            data, tanh_scale = datasets[name]
+            tanh_value = agentParams[tanh_scale] if isinstance(tanh_scale, str) else tanh_scale
+            key = self.get_key(weights, data, tanh_value, agentParams)
+            entry = self.get(key)
+            if entry is None:
+                records = {}
+                row = _evaluate_datasets(policy, agentParams, {name: datasets[name]}, episode, 
+                                         checkpoint_path, records = records)[0]
+                self.put(key, records[name]["actions"], records[name]["probs"], row)
+                row["cached"] = False
+            else:
+                row = entry["row"]
+                row.update({"episode":episode, "dataset":name, "cached":True})
+            rows.append(row)
+        return rows
+    
+    def get_actions(self, policy, agentParams: dict, data: np.array, tanh_scale) -> dict:
+        '''
+        Cached actions and probabilities of the policy on data, None if the 
+        evaluation is not cached
+        '''
+        tanh_value = agentParams[tanh_scale] if isinstance(tanh_scale, str) else tanh_scale
+        return self.get(self.get_key(policy.actor_local.model.get_weights(), data, tanh_value, agentParams))
+
+
+#%% Vectorized backtesting
+class BatchBacktester:
+    '''
+    Vectorized counterpart of UtilFuncs.evaluate_policy. The greedy policy of
+    an actor is run over a batch of price paths at once, every time step the 
+    states of all paths go through the actor as a single batch and the 
+    buy/sell/impossible/extra cash handling of UtilFuncs.handle_action 
+    (validation setting) is applied to all paths with array operations.
+    
+    Paths are given as an (n_paths, length) array which includes the window 
+    prefix, i.e. every row is laid out like data_val in the main notebook.
+    Trade costs may be given per path which allows grids of cost settings.
+    Only a budget of one stock (n_budget = 1) is supported, masked inputs 
+    (mask_input) are applied per path.
+    '''
+    def __init__(self, policy, tanh_scale, extraCash = 0.):
+        if policy.n_budget != 1:
+            raise Exception("Vectorized backtesting only supports n_budget = 1")
+        self.policy = policy
+        if isinstance(tanh_scale, str):
+            tanh_scale = getattr(policy, tanh_scale)
+        self.tanh_scale = tanh_scale
+        self.extraCash = extraCash
+    
+    def get_utilStates(self, p, n_holds, holding, balance, bought_price, sold_price, trade_cost) -> np.array:
+        '''
+        Vectorized UtilFuncs.get_utilState, returns an (n_paths, 6) array
+        '''
+        balance_bool = np.where(holding, 0., (balance-trade_cost > p).astype(float))
+        nholds_norm = np.minimum(1,n_holds/max(self.policy.max_holds, 100))
+        profit = np.where(holding, p-bought_price-trade_cost, sold_price-p-trade_cost)
+        buy_bool = np.where(holding, 0., (sold_price-trade_cost > p).astype(float))
+        sell_bool = np.where(holding, (bought_price+trade_cost < p).astype(float), 0.)
+        return np.stack([balance_bool, nholds_norm, holding.astype(float),
+                         buy_bool, sell_bool, profit/p], axis = 1)
+    
+    def run(self, paths: np.array, trade_cost = None, tradecost_actual = None, 
+            keep_actions = False) -> dict:
+        '''
+        Runs the policy over all paths and returns a dictionary of per path 
+        results (arrays of length n_paths). trade_cost (used for feasibility 
+        and the state) and tradecost_actual (subtracted from the profit) 
+        default to the settings of the policy and may be scalars or arrays
+        '''
+        paths = np.asarray(paths, dtype = float)
+        n, length = paths.shape
+        window_size = self.policy.stateTS_size
+        if trade_cost is None:
+            trade_cost = self.policy.trade_cost
+        if tradecost_actual is None:
+            tradecost_actual = self.policy.TRADECOST_ACTUAL
+        trade_cost = np.broadcast_to(np.asarray(trade_cost, dtype = float), (n,))
+        tradecost_actual = np.broadcast_to(np.asarray(tradecost_actual, dtype = float), (n,))
+        
+        returns = np.tanh(np.diff(paths, axis = 1)/self.tanh_scale).astype(np.float32)
+        
+        # portfolio after agent.reset(data[window_size]) 
+        start = paths[:,window_size]
+        budget = start.copy() # stats.budget 
+        balance = np.full(n, float(self.extraCash))
+        extraCash = np.full(n, float(self.extraCash))
+        holding = np.ones(n, dtype = bool)
+        bought_price = start.copy()
+        sold_price = np.full(n, np.nan) # inventory_conj is empty
+        n_holds = np.zeros(n)
+        n_trades = np.zeros(n)
+        n_posiProfits = np.zeros(n)
+        n_impossible = np.zeros(n)
+        n_1or2 = np.ones(n)
+        exposure = np.zeros(n)
+        peak = np.full(n, -np.inf)
+        max_drawdown = np.zeros(n)
+        growth = np.zeros(n)
+        actions = []
+        
+        for t in range(window_size,length-1):
+            p = paths[:,t]
+            states_ts = returns[:,t-window_size:t,None]
+            if self.policy.mask_input:
+                # only the returns since the last trade, see UtilFuncs.get_state
+                k = np.maximum(1, np.minimum(n_holds, window_size+1))
+                keep = np.arange(window_size)[None,:] >= (window_size-k)[:,None]
+                states_ts = np.where(keep[:,:,None], states_ts, 0.).astype(np.float32)
+            states_ut = self.get_utilStates(p, n_holds, holding, balance, bought_price, 
+                                            sold_price, trade_cost).astype(np.float32)
+            action_bin = np.argmax(self.policy.predict(states_ts, states_ut), axis = 1)
+            
+            # binary to three dimension mapping and handling of the actions
+            hold = action_bin == 0
+            buy = (action_bin == 1) & ~holding
+            sell = (action_bin == 1) & holding
+            n_1or2 += ~hold
+            n_holds += hold
+            
+            buy_ok = buy & (balance-trade_cost > p)
+            impossible = buy & ~buy_ok
+            profit = np.where(buy_ok, sold_price-p-trade_cost, 0.)
+            profit = np.where(sell, p-bought_price-trade_cost, profit)
+            change = np.where(buy_ok, -p-trade_cost, 0.)
+            change = np.where(sell, p-trade_cost, change)
+            sold_price = np.where(sell, p, sold_price)
+            bought_price = np.where(buy_ok, p, bought_price)
+            holding = (holding & ~sell) | buy_ok
+            n_impossible += impossible
+            n_holds += impossible
+            
+            # validation setting; extra cash instead of an impossible buy
+            extra = impossible & (balance-trade_cost < p)
+            extraCash += np.where(extra, p-balance-trade_cost, 0.)
+            balance = np.where(extra, 0., balance)
+            holding = holding | extra
+            bought_price = np.where(extra, p, bought_price)
+            profit = np.where(extra, 0., profit)
+            
+            traded = buy_ok | sell | extra
+            n_trades += traded
+            n_holds = np.where(traded, 0, n_holds)
+            n_posiProfits += profit > 0
+            balance = balance+change
+            
+            growth = balance+holding*p-budget-2*extraCash-tradecost_actual*n_trades
+            exposure += holding
+            equity = budget+growth
+            peak = np.maximum(peak, equity)
+            max_drawdown = np.maximum(max_drawdown, (peak-equity)/peak)
+            if keep_actions:
+                actions.append(np.where(sell, 2, np.where(buy, 1, 0)))
+        
+        profit_buyhold = paths[:,-2]-start
+        results = {"profit":growth,
+                   "profit_buyhold":profit_buyhold,
+                   "profit_diff":growth-profit_buyhold,
+                   "n_trades":n_trades,
+                   "n_posiProfits":n_posiProfits,
+                   "n_impossible":n_impossible,
+                   "extraCash":extraCash,
+                   "max_drawdown":max_drawdown,
+                   "exposure":exposure/max(1,length-1-window_size)}
+        if keep_actions:
+            results["actions"] = np.stack(actions, axis = 1)
+        return results
+    
+
+class PathGenerator:
+    '''
+    Generates synthetic price paths as one (n_paths, length) array from the 
+    log returns of a historical price series (e.g. traindata.csv), using 
+    geometric brownian motion, a block bootstrap of the historical returns or
+    a two state (calm/volatile) regime switching model
+    '''
+    def __init__(self, data: np.array, seed = None, vol_window = 20):
+        self.data = np.asarray(data, dtype = float)
+        self.log_returns = np.diff(np.log(self.data))
+        self.rng = np.random.default_rng(seed)
+        self.vol_window = vol_window
+    
+    def _to_prices(self, log_returns: np.array, start_price) -> np.array:
+        if start_price is None:
+            start_price = self.data[-1]
+        paths = np.empty((log_returns.shape[0], log_returns.shape[1]+1))
+        paths[:,0] = 0.
+        np.cumsum(log_returns, axis = 1, out = paths[:,1:])
+        return start_price*np.exp(paths)
+    
+    def gbm(self, n_paths: int, length: int, start_price = None, mu = None, sigma = None) -> np.array:
+        '''
+        Geometric brownian motion, drift and volatility default to the
+        (daily) estimates of the historical log returns
+        '''
+        if mu is None:
+            mu = np.mean(self.log_returns)
+        if sigma is None:
+            sigma = np.std(self.log_returns)
+        log_returns = mu+sigma*self.rng.standard_normal((n_paths, length-1))
+        return self._to_prices(log_returns, start_price)
+    
+    def block_bootstrap(self, n_paths: int, length: int, block_size = 20, start_price = None) -> np.array:
+        '''
+        Moving block bootstrap, concatenates randomly chosen blocks of 
+        consecutive historical returns which preserves short term dependence
+        '''
+        n_blocks = int(np.ceil((length-1)/block_size))
+        starts = self.rng.integers(0, len(self.log_returns)-block_size+1, size = (n_paths, n_blocks))
+        index = (starts[:,:,None]+np.arange(block_size)[None,None,:]).reshape(n_paths,-1)[:,:length-1]
+        return self._to_prices(self.log_returns[index], start_price)
+    
+    def estimate_regimes(self) -> dict:
+        '''
+        Splits the historical returns in a calm and volatile regime by the 
+        median of the rolling volatility and estimates the drift, volatility
+        and transition matrix of both regimes
+        '''
+        vol = pd.Series(self.log_returns).rolling(self.vol_window, min_periods = 2).std().bfill().to_numpy()
+        regime = (vol > np.median(vol)).astype(int)
+        mu = [np.mean(self.log_returns[regime == k]) for k in range(2)]
+        sigma = [np.std(self.log_returns[regime == k]) for k in range(2)]
+        transition = np.zeros((2,2))
+        np.add.at(transition, (regime[:-1], regime[1:]), 1)
+        transition /= transition.sum(axis = 1, keepdims = True)
+        return {"mu":np.array(mu), "sigma":np.array(sigma), "transition":transition}
+    
+    def regime_switching(self, n_paths: int, length: int, start_price = None, regimes = None) -> np.array:
+        '''
+        Markov regime switching geometric brownian motion, regimes defaults 
+        to the output of estimate_regimes
+        '''
+        if regimes is None:
+            regimes = self.estimate_regimes()
+        mu, sigma, transition = regimes["mu"], regimes["sigma"], regimes["transition"]
+        stationary = transition[1,0]/(transition[0,1]+transition[1,0])
+        state = (self.rng.random(n_paths) > stationary).astype(int)
+        uniforms = self.rng.random((n_paths, length-1))
+        shocks = self.rng.standard_normal((n_paths, length-1))
+        log_returns = np.empty((n_paths, length-1))
+        for t in range(length-1):
+            log_returns[:,t] = mu[state]+sigma[state]*shocks[:,t]
+            state = (uniforms[:,t] < transition[state,1]).astype(int) # probability of moving to/staying in state 1
+        return self._to_prices(log_returns, start_price)
+    
+
+class MonteCarloStress:
+    '''
+    Monte Carlo stress test of a trained actor, generates synthetic price 
+    paths (PathGenerator) and runs the greedy policy over all of them in a 
+    vectorized manner (BatchBacktester). Paths are processed in chunks to 
+    bound the memory usage.
+    '''
+    def __init__(self, policy, data: np.array, tanh_scale = "test_tanh", seed = None, extraCash = 0.):
+        self.generator = PathGenerator(data, seed = seed)
+        self.backtester = BatchBacktester(policy, tanh_scale, extraCash = extraCash)
+        self.window_size = policy.stateTS_size
+    
+    def run(self, n_paths = 1000, horizon = 252, method = "gbm", chunk = None, **kwargs) -> pd.DataFrame:
+        '''
+        Returns a table with the results per path, method is one of "gbm",
+        "bootstrap" or "regime", kwargs are passed to the path generator. 
+        By default the chunk size is the rollout width of the machine profile
+        '''
+        if chunk is None:
+            chunk = load_machineProfile().get("rollout_width", 4096)
+        generate = {"gbm":self.generator.gbm,
+                    "bootstrap":self.generator.block_bootstrap,
+                    "regime":self.generator.regime_switching}[method]
+        length = self.window_size+horizon+1
+        tables = []
+        for start in range(0, n_paths, chunk):
+            paths = generate(min(chunk, n_paths-start), length, **kwargs)
+            tables.append(pd.DataFrame(self.backtester.run(paths)))
+        results = pd.concat(tables, ignore_index = True)
+        results["method"] = method
+        return results
+    
+    def summarize(self, results: pd.DataFrame, quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]) -> pd.DataFrame:
+        '''
+        Returns the mean and quantiles of the result distributions
+        '''
+        columns = ["profit", "profit_buyhold", "profit_diff", "max_drawdown", "n_trades", 
+                   "n_impossible", "extraCash", "exposure"]
+        summary = results[columns].quantile(quantiles)
+        summary.loc["mean"] = results[columns].mean()
+        summary.loc["fraction_positive"] = (results[columns] > 0).mean()
+        return summary
+    
+    
+class CostSensitivity:
+    '''
+    Transaction cost sensitivity of a trained actor. All cost settings of a 
+    grid are backtested in one pass, every grid point is a row of the batch 
+    of BatchBacktester (the price series is repeated per cost), hence the 
+    feasibility of the buys and the cost dependent state features 
+    (balance_bool, buy_bool, sell_bool, profit) follow the cost of the row.
+    '''
+    def __init__(self, policy, tanh_scale = "vali_tanh", extraCash = 0.):
+        self.backtester = BatchBacktester(policy, tanh_scale, extraCash = extraCash)
+        self.policy = policy
+    
+    def run(self, data: np.array, costs: list, vary = "both") -> pd.DataFrame:
+        '''
+        Returns a table with the results per cost (and per path if data is 
+        an (n_paths, length) array). vary selects what the grid changes:
+            "both"             : trade_cost and TRADECOST_ACTUAL equal to the cost
+            "trade_cost"       : feasibility/state cost, TRADECOST_ACTUAL of the policy
+            "tradecost_actual" : cost subtracted from the profit only, the 
+                                 actions are those of the policy's trade_cost
+        '''
+        if vary not in ["both", "trade_cost", "tradecost_actual"]:
+            raise Exception("Unknown cost setting {0}".format(vary))
+        paths = np.atleast_2d(np.asarray(data, dtype = float))
+        costs = np.asarray(costs, dtype = float)
+        n_paths, n_costs = len(paths), len(costs)
+        grid = np.tile(costs, n_paths) # row i*n_costs+j: path i, cost j
+        trade_cost = grid if vary != "tradecost_actual" else self.policy.trade_cost
+        tradecost_actual = grid if vary != "trade_cost" else self.policy.TRADECOST_ACTUAL
+        
+        results = pd.DataFrame(self.backtester.run(np.repeat(paths, n_costs, axis = 0), 
+                                                   trade_cost = trade_cost, 
+                                                   tradecost_actual = tradecost_actual))
+        results.insert(0, "cost", grid)
+        results.insert(0, "path", np.repeat(np.arange(n_paths), n_costs))
+        results["vary"] = vary
+        return results
+    
+    def get_curve(self, results: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Cost versus excess profit (profit_diff, vs buy and hold) curve, 
+        averaged over the paths
+        '''
+        columns = ["profit", "profit_diff", "n_trades", "n_impossible", "extraCash", "max_drawdown", "exposure"]
+        curve = results.groupby("cost")[columns].mean()
+        curve["breakeven"] = curve["profit_diff"] > 0
+        return curve
+    
+    def plot_curve(self, curve: pd.DataFrame, path = None, show = False):
+        '''
+        Plots the excess profit and the number of trades against the cost
+        '''
+        fig = make_subplots(specs=[[{"secondary_y": True}]])
+        fig.add_trace(pgo.Scatter(x = curve.index, y = curve["profit_diff"], mode = "lines+markers", 
+                                  name = "excess profit vs buyhold"), secondary_y = False)
+        fig.add_trace(pgo.Scatter(x = curve.index, y = curve["n_trades"], mode = "lines+markers", 
+                                  name = "trades", line = dict(dash = "dot")), secondary_y = True)
+        fig.update_layout(title = "Transaction cost sensitivity", xaxis_title = "cost per trade")
+        fig.update_yaxes(title_text = "excess profit", secondary_y = False)
+        fig.update_yaxes(title_text = "trades", secondary_y = True)
+        if path is not None:
+            fig.write_html(path)
+        if show:
+            fig.show()
+        return fig
+
+
+#%% Walk-forward retraining
+class WalkForward:
+    '''
+    Walk-forward retraining over one long price series. The train, 
+    validation and test windows are rolled forward by step prices per fold.
+    The first fold trains for first_episodes, every later fold continues 
+    from the networks (and optimizers) selected on the previous validation 
+    window and from its replay buffer, from which the transitions older 
+    than max_age prices before the new train window are evicted, and 
+    fine-tunes for fold_episodes (and at most max_time seconds). 
+    
+    Training episodes are subset episodes of subset_window prices sampled 
+    from the train window and run with Agent.rollout_episode (rewardType 7,
+    n_budget 1). Every vali_every episodes the greedy policy is backtested 
+    on the validation window, the networks with the best excess profit are
+    kept (and checkpointed) and scored on the test window at the end of the
+    fold. Every fold has its own checkpoint directory f{k}, the per fold 
+    results are returned and written to walkforward.csv.
+    '''
+    def __init__(self, agentParams: dict, data: np.array, checkpoint_dir: str, rewardParams: dict, 
+                 extraParams: dict, train_size: int, vali_size: int, test_size: int, step: int,
+                 first_episodes = 50, fold_episodes = 10, vali_every = 5, max_age = 0, 
+                 max_time = None, seed = None):
+        self.agentParams = agentParams
+        self.rewardParams = rewardParams
+        self.extraParams = extraParams
+        self.data = np.asarray(data, dtype = float)
+        self.checkpoint_dir = checkpoint_dir
+        self.train_size = train_size
+        self.vali_size = vali_size
+        self.test_size = test_size
+        self.step = step
+        self.first_episodes = first_episodes
+        self.fold_episodes = fold_episodes
+        self.vali_every = vali_every
+        self.max_age = max_age 
+        self.max_time = max_time
+        self.rng = np.random.default_rng(seed)
+        self.window_size = agentParams["stateTS_size"]
+        if agentParams["subset_window"] >= train_size-self.window_size:
+            raise Exception("The train window must be longer than the subset window and the state window")
+        self.agent = None
+        self.results = []
+    
+    def get_folds(self) -> list:
+        '''
+        [train_start, train_end, vali_end, test_end] per fold, validation 
+        and test windows directly follow the train window (their state 
+        windows overlap with the previous window)
+        '''
+        folds = []
+        start = 0
+        while start+self.train_size+self.vali_size+self.test_size < len(self.data):
+            train_end = start+self.train_size
+            folds.append([start, train_end, train_end+self.vali_size, train_end+self.vali_size+self.test_size])
+            start += self.step
+        return folds
+    
+    def backtest(self, start: int, end: int, tanh_key: str) -> dict:
+        '''
+        Greedy backtest of the current local actor over prices [start, end), 
+        the state window is taken from the prices before start
+        '''
+        policy = PolicyAgent(self.agent.attr_dct)
+        policy.actor_local.model.set_weights(self.agent.actor_local.model.get_weights())
+        path = self.data[start-self.window_size:end+1][None]
+        results = BatchBacktester(policy, tanh_key).run(path)
+        return {key: float(value[0]) for key, value in results.items()}
+    
+    def get_networks(self) -> list:
+        return [net.model.get_weights() for net in [self.agent.actor_local, self.agent.actor_target, 
+                                                   self.agent.critic_local, self.agent.critic_target]]
+    
+    def set_networks(self, weights: list):
+        for net, net_weights in zip([self.agent.actor_local, self.agent.actor_target, 
+                                     self.agent.critic_local, self.agent.critic_target], weights):
+            net.model.set_weights(net_weights)
+    
+    def run_fold(self, k: int, fold: list) -> dict:
+        train_start, train_end, vali_end, test_end = fold
+        fold_dir = os.path.join(self.checkpoint_dir, "f{}".format(k))
+        n_evicted = 0
+        if self.agent is None:
+            self.agent = Agent(self.agentParams, self.data[train_start+self.window_size], fold_dir, 
+                               self.rewardParams, self.extraParams)
+            n_episodes = self.first_episodes
+        else:
+            self.agent.switch_checkpointDir(fold_dir)
+            n_evicted = self.agent.evict_before(train_start-self.max_age)
+            n_episodes = self.fold_episodes
+        agent = self.agent
+        agent.scheduler.reset_report()
+        
+        best, best_weights, best_episode = -np.inf, None, -1
+        stats = Statistics(fold_dir, retain_traces = False)
+        time_start = time.time()
+        for e in range(n_episodes):
+            episode_start = int(self.rng.integers(max(train_start, self.window_size), 
+                                                  train_end-agent.subset_window-1))
+            episode_end = episode_start+agent.subset_window
+            stats.reset_all(agent.n_budget*self.data[episode_start], 
+                            self.data[episode_start:episode_end]-self.data[episode_start])
+            agent.rollout_episode(self.data, episode_start, episode_end, stats, agent.train_tanh)
+            stats.collect_episode(agent, e, None)
+            
+            last = e == n_episodes-1 or (self.max_time is not None and time.time()-time_start > self.max_time)
+            if (e+1) % self.vali_every == 0 or last:
+                vali = self.backtest(train_end, vali_end, "vali_tanh")
+                print("F{0} E{1} - training profit = {2} | validation profit = {3} (diff {4})".format(
+                      k, e, round(stats.growth[-1],2), round(vali["profit"],2), round(vali["profit_diff"],2)))
+                if vali["profit_diff"] > best:
+                    best, best_weights, best_episode = vali["profit_diff"], self.get_networks(), e
+                    agent.save_models(e, metric = best)
+            if last:
+                break
+        train_time = time.time()-time_start
+        schedule = agent.scheduler.report()
+        
+        # test the selected networks, which are also the start of the next fold
+        self.set_networks(best_weights)
+        vali = self.backtest(train_end, vali_end, "vali_tanh")
+        test = self.backtest(vali_end, test_end, "test_tanh")
+        result = {"fold":k, "train_start":train_start, "train_end":train_end, 
+                  "vali_end":vali_end, "test_end":test_end,
+                  "episodes":e+1, "best_episode":best_episode, "train_time":train_time,
+                  "env_steps":schedule["env_steps"], "grad_steps":schedule["grad_steps"],
+                  "evicted":n_evicted, "buffer":min(agent.memory.memory_size, agent.memory.memory_counter)}
+        result.update({"validation_"+key: vali[key] for key in ["profit", "profit_diff", "n_trades", "max_drawdown"]})
+        result.update({"test_"+key: test[key] for key in ["profit", "profit_diff", "n_trades", "max_drawdown"]})
+        result.update({"training_"+key: value for key, value in stats.get_metrics().items() 
+                       if key in ["sharpe", "max_drawdown", "win_rate"]})
+        agent.log_metrics(best_episode, {key: value for key, value in result.items() 
+                                         if key.startswith(("validation_", "test_"))})
+        return result
+    
+    def run(self, n_folds = None) -> pd.DataFrame:
+        '''
+        Runs (the next n_folds of) the walk-forward folds and returns the 
+        results of all folds so far
+        '''
+        folds = self.get_folds()
+        todo = range(len(self.results), len(folds) if n_folds is None else min(len(folds), len(self.results)+n_folds))
+        for k in todo:
+            self.results.append(self.run_fold(k, folds[k]))
+            results = pd.DataFrame(self.results).set_index("fold")
+            results.to_csv(os.path.join(self.checkpoint_dir, "walkforward.csv"))
+        return pd.DataFrame(self.results).set_index("fold")
@@ -0,0 +1,54 @@
+'''
+Machine profile of the AutoTuner (thread pools, oneDNN, batch size and rollout width)
+'''
+import os
+import sys
+import json
+import platform
+
+# machine profile written by the AutoTuner, applied with apply_machineProfile()
+MACHINE_PROFILE = os.environ.get("AE4350_MACHINE_PROFILE", 
+                                 os.path.join(os.path.expanduser("~"), ".ae4350", "machine_profile.json"))
+
+def get_machineInfo() -> dict:
+    return {"node":platform.node(), "cpu_count":os.cpu_count(), "processor":platform.processor()}
+
+def load_machineProfile(path = None) -> dict:
+    '''
+    Returns the machine profile of the auto-tuner, an empty dictionary if 
+    there is none, if it was made on another machine or if the environment 
+    variable AE4350_IGNORE_PROFILE is set
+    '''
+    if path is None:
+        path = MACHINE_PROFILE
+    if os.environ.get("AE4350_IGNORE_PROFILE") or not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as fp:
+        profile = json.load(fp)
+    machine = get_machineInfo()
+    if any(profile.get("machine",{}).get(key) != machine[key] for key in ["node","cpu_count"]):
+        return {}
+    return profile
+
+def apply_machineProfile(path = None) -> dict:
+    '''
+    Configures oneDNN and the tensorflow thread pools according to the 
+    machine profile and returns the profile. Must run before any tensorflow
+    operation, and for the oneDNN setting (TF_ENABLE_ONEDNN_OPTS, read when
+    tensorflow is imported) before tensorflow is imported, i.e. before 
+    importing utility
+    '''
+    profile = load_machineProfile(path)
+    if not profile:
+        return profile
+    if "TF_ENABLE_ONEDNN_OPTS" in profile and "tensorflow" not in sys.modules:
+        os.environ["TF_ENABLE_ONEDNN_OPTS"] = str(profile["TF_ENABLE_ONEDNN_OPTS"])
+    elif "TF_ENABLE_ONEDNN_OPTS" in profile and os.environ.get("TF_ENABLE_ONEDNN_OPTS") != str(profile["TF_ENABLE_ONEDNN_OPTS"]):
+        print("WARNING: tensorflow is already imported, the oneDNN setting of the machine profile is not applied")
+    import tensorflow as tf # after TF_ENABLE_ONEDNN_OPTS is set
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(profile.get("intra_op_threads",0))
+        tf.config.threading.set_inter_op_parallelism_threads(profile.get("inter_op_threads",0))
+    except RuntimeError:
+        print("WARNING: tensorflow is already initialised, the thread settings of the machine profile are not applied")
+    return profile
@@ -0,0 +1,154 @@
+'''
+Memory accounting of buffers, statistics and models
+'''
+import numpy as np
+import os
+import pandas as pd
+import platform
+import sys
+
+#%% Memory accounting
+class MemoryMonitor:
+    '''
+    Itemizes the memory held by an agent: the replay buffer, the retained 
+    traces of the Statistics containers, the attribute dictionary and the 
+    keras models with their optimizer slots, next to the resident set size 
+    of the process. sample is meant to be called once per episode next to 
+    the training log, e.g.
+    
+        monitor = MemoryMonitor(agent, [stats, stats_val], budgets = {"rss":8e9}, action = "trim")
+        ...
+        monitor.sample(e, history) # adds memory_* entries to history
+    
+    budgets maps a component of the report (or "total"/"rss") to a number 
+    of bytes. When a budget is exceeded a warning is printed ("warn") or, 
+    for "trim", the Statistics traces are trimmed to the last trim_keep 
+    episodes first (the summaries remain, the trace plots of older episodes
+    are lost).
+    '''
+    def __init__(self, agent, stats = [], budgets = {}, action = "warn", trim_keep = 5, verbose = True):
+        if action not in ["warn", "trim"]:
+            raise Exception("Unknown budget action {0}, use warn or trim".format(action))
+        self.agent = agent
+        self.stats = list(stats)
+        self.budgets = dict(budgets)
+        self.action = action
+        self.trim_keep = trim_keep
+        self.verbose = verbose
+        self.history = [] # one report per sample
+        
+    def nbytes(obj, seen = None) -> int:
+        '''
+        Approximate deep size of (nested) lists, dicts and arrays in bytes, 
+        summed over all elements. Objects referenced more than once (e.g. the
+        current episode lists which are also stored in the every*_dct, or 
+        the cached small integers of the action traces) are counted once per
+        seen set
+        '''
+        seen = set() if seen is None else seen
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            return int(obj.nbytes)
+        if isinstance(obj, dict):
+            return sys.getsizeof(obj)+sum(sys.getsizeof(key)+MemoryMonitor.nbytes(value, seen) for key, value in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return sys.getsizeof(obj)+sum(MemoryMonitor.nbytes(value, seen) for value in obj)
+        return sys.getsizeof(obj)
+    
+    def get_rss() -> int:
+        '''
+        Current resident set size of the process in bytes (peak size if 
+        /proc is not available)
+        '''
+        try:
+            with open("/proc/self/statm", "r") as fp:
+                return int(fp.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return int(rss if platform.system() == "Darwin" else rss*1024)
+        
+    def get_bufferBytes(self) -> int:
+        memory = getattr(self.agent, "memory", None)
+        if memory is None:
+            return 0
+        return sum(int(getattr(memory, name).nbytes) for name in 
+                   ["memory_state", "memory_nextState", "memory_action", "memory_reward", "memory_dones", "memory_time"])
+    
+    def get_statisticsBytes(self) -> int:
+        total, seen = 0, set()
+        for stats in self.stats:
+            total += sum(MemoryMonitor.nbytes(value, seen) for key, value in stats.__dict__.items() 
+                         if isinstance(value, (list, dict)))
+        return total
+    
+    def get_modelBytes(self) -> tuple:
+        '''
+        Bytes of the model weights and of the optimizer slots (Adam moments),
+        shared variables (e.g. a shared encoder) are counted once
+        '''
+        weights, slots = {}, {}
+        for name in ["actor_local", "actor_target", "critic_local", "critic_target"]:
+            net = getattr(self.agent, name, None)
+            if net is None:
+                continue
+            for w in net.model.weights:
+                weights[w.ref()] = int(np.prod(w.shape))*w.dtype.size
+            optimizer = getattr(net, "optimizer", None) or getattr(net.model, "optimizer", None)
+            if optimizer is not None:
+                for w in optimizer.variables():
+                    slots[w.ref()] = int(np.prod(w.shape))*w.dtype.size
+        return sum(weights.values()), sum(slots.values())
+        
+    def report(self) -> dict:
+        '''
+        Itemized memory in bytes
+        '''
+        weights, slots = self.get_modelBytes()
+        report = {"replay_buffer": self.get_bufferBytes(),
+                  "statistics": self.get_statisticsBytes(),
+                  "attr_dct": MemoryMonitor.nbytes(getattr(self.agent, "attr_dct", {})),
+                  "models": weights,
+                  "optimizer_slots": slots}
+        report["total"] = sum(report.values())
+        report["rss"] = MemoryMonitor.get_rss()
+        return report
+    
+    def get_exceeded(self, report: dict) -> list:
+        return [key for key, budget in self.budgets.items() if report.get(key, 0) > budget]
+    
+    def sample(self, episode: int, history = None) -> dict:
+        '''
+        Reports the memory of this episode, applies the budgets and appends 
+        the report (in MB) to history["memory_<component>"] if given
+        '''
+        report = self.report()
+        exceeded = self.get_exceeded(report)
+        n_trimmed = 0
+        if exceeded and self.action == "trim":
+            n_trimmed = sum(stats.trim_traces(self.trim_keep) for stats in self.stats)
+            report = self.report()
+            exceeded = self.get_exceeded(report)
+        if exceeded:
+            print("WARNING: E{0} memory budget exceeded for {1}".format(episode, 
+                  ", ".join("{0} ({1} > {2} MB)".format(key, round(report[key]/1e6,1), round(self.budgets[key]/1e6,1)) 
+                            for key in exceeded)))
+        report["episode"] = episode
+        report["trimmed"] = n_trimmed
+        self.history.append(report)
+        
+        if history is not None:
+            for key in ["replay_buffer", "statistics", "attr_dct", "models", "optimizer_slots", "total", "rss"]:
+                history.setdefault("memory_"+key, []).append(report[key]/1e6)
+        if self.verbose:
+            print("E{0} - Memory [MB] rss = {1} | buffer = {2} | statistics = {3} | models = {4} (+{5} optimizer){6}".format(
+                  episode, round(report["rss"]/1e6,1), round(report["replay_buffer"]/1e6,1), 
+                  round(report["statistics"]/1e6,1), round(report["models"]/1e6,1), 
+                  round(report["optimizer_slots"]/1e6,1), 
+                  " | trimmed {0} traces".format(n_trimmed) if n_trimmed else ""))
+        return report
+    
+    def get_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.history).set_index("episode")
@@ -0,0 +1,213 @@
+'''
+SQLite index of runs, hyperparameters, metrics and checkpoints
+'''
+import numpy as np
+import os
+import pandas as pd
+import json
+import re
+import time
+import sqlite3
+import contextlib
+
+#%% Run registry
+class RunRegistry:
+    '''
+    Local SQLite index of runs, their hyperparameters, per episode metrics 
+    and checkpoints, such that runs can be compared without parsing their 
+    (large) json files. Runs register themselves while training if 
+    run_registry (path of the database) is set in the agent parameters, 
+    existing run folders can be added with import_run/import_runs.
+    
+    Hyperparameters are flattened (model_hyper.actor_regularizer etc.) and 
+    both the metrics and the parameters are stored in long format, e.g.:
+        registry.best_by("hold_scale", "validation_profit")
+        registry.query("SELECT * FROM metrics WHERE name = ?", ["training_profit"])
+    '''
+    def __init__(self, db_path = "runs.sqlite"):
+        self.db_path = db_path
+        with self.connect() as con:
+            con.executescript('''
+                PRAGMA journal_mode = WAL;
+                CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, path TEXT UNIQUE, 
+                                                 name TEXT, created REAL, params TEXT);
+                CREATE TABLE IF NOT EXISTS params (run_id INTEGER, key TEXT, value_num REAL, value_text TEXT,
+                                                   PRIMARY KEY (run_id, key));
+                CREATE TABLE IF NOT EXISTS metrics (run_id INTEGER, episode INTEGER, name TEXT, value REAL,
+                                                    PRIMARY KEY (run_id, episode, name));
+                CREATE TABLE IF NOT EXISTS checkpoints (run_id INTEGER, episode INTEGER, format TEXT, 
+                                                        path TEXT, metric REAL, PRIMARY KEY (run_id, episode));
+                CREATE INDEX IF NOT EXISTS params_key ON params (key, value_num, value_text);
+                CREATE INDEX IF NOT EXISTS metrics_name ON metrics (name, value);
+            ''')
+    
+    def connect(self):
+        # short lived connections, the registry may be used from several threads/processes
+        return contextlib.closing(sqlite3.connect(self.db_path, timeout = 30, isolation_level = None))
+    
+    def flatten_params(params: dict, prefix = "") -> dict:
+        flat = {}
+        for key, value in params.items():
+            if isinstance(value, dict):
+                flat.update(RunRegistry.flatten_params(value, prefix+key+"."))
+            else:
+                flat[prefix+key] = value
+        return flat
+    
+    def register_run(self, run_path: str, params: dict) -> int:
+        '''
+        Adds (or updates) a run and its hyperparameters, returns the run id
+        '''
+        run_path = os.path.abspath(run_path)
+        rows = []
+        for key, value in RunRegistry.flatten_params(params).items():
+            if isinstance(value, (bool, int, float, np.number)) and not isinstance(value, str):
+                rows.append([key, float(value), None])
+            else:
+                rows.append([key, None, json.dumps(value) if not isinstance(value, str) else value])
+        with self.connect() as con:
+            con.execute("BEGIN")
+            con.execute("INSERT OR IGNORE INTO runs (path, name, created, params) VALUES (?,?,?,?)",
+                        [run_path, os.path.basename(run_path), time.time(), json.dumps(params, default = str)])
+            con.execute("UPDATE runs SET params = ? WHERE path = ?", [json.dumps(params, default = str), run_path])
+            run_id = con.execute("SELECT run_id FROM runs WHERE path = ?", [run_path]).fetchone()[0]
+            con.execute("DELETE FROM params WHERE run_id = ?", [run_id])
+            con.executemany("INSERT INTO params VALUES (?,?,?,?)", [[run_id]+row for row in rows])
+            con.execute("COMMIT")
+        return run_id
+    
+    def get_runId(self, run_path: str) -> int:
+        with self.connect() as con:
+            row = con.execute("SELECT run_id FROM runs WHERE path = ?", [os.path.abspath(run_path)]).fetchone()
+        if row is None:
+            raise Exception("Run {} is not registered".format(run_path))
+        return row[0]
+    
+    def log_metrics(self, run_path: str, episode: int, metrics: dict):
+        '''
+        Stores the (summary) metrics of an episode, e.g. 
+        {"training_profit":..., "validation_profit":...}
+        '''
+        self._insert_metrics(self.get_runId(run_path), {episode: metrics})
+    
+    def _insert_metrics(self, run_id: int, metrics: dict):
+        rows = [[run_id, int(episode), name, float(value)] for episode in metrics
+                for name, value in metrics[episode].items() if value is not None]
+        with self.connect() as con:
+            con.execute("BEGIN")
+            con.executemany("INSERT OR REPLACE INTO metrics VALUES (?,?,?,?)", rows)
+            con.execute("COMMIT")
+    
+    def log_checkpoint(self, run_path: str, episode: int, checkpoint_format: str, path: str, metric = None):
+        run_id = self.get_runId(run_path)
+        with self.connect() as con:
+            con.execute("INSERT OR REPLACE INTO checkpoints VALUES (?,?,?,?,?)",
+                        [run_id, int(episode), checkpoint_format, os.path.abspath(path), 
+                         None if metric is None else float(metric)])
+    
+    def remove_checkpoint(self, run_path: str, episode: int):
+        with self.connect() as con:
+            con.execute("DELETE FROM checkpoints WHERE run_id = ? AND episode = ?", [self.get_runId(run_path), int(episode)])
+    
+    def import_run(self, run_path: str) -> int:
+        '''
+        Imports an existing run folder: agent_parameters.json, the per episode
+        lists of EXTRAhistory.json, the saved episode metrics of history.json 
+        and the checkpoints. The history lists hold one entry per saved 
+        episode, which are recorded in history["episode"] (Agent.save_history).
+        Older runs only have e{episode}/history.json, its entries are matched
+        to the checkpoints if none have been removed, otherwise they are skipped
+        '''
+        with open(os.path.join(run_path, 'agent_parameters.json'), 'r') as fp:
+            run_id = self.register_run(run_path, json.load(fp))
+        
+        checkpoints = {}
+        for name in os.listdir(run_path):
+            if re.fullmatch(r"e\d+", name) and os.path.isdir(os.path.join(run_path, name)):
+                checkpoints[int(name[1:])] = ["h5", os.path.join(run_path, name)]
+            elif re.fullmatch(r"e\d+\.ckpt\.npz", name):
+                checkpoints[int(name[1:-len(".ckpt.npz")])] = ["npz", os.path.join(run_path, name)]
+        index = {}
+        if os.path.isfile(os.path.join(run_path, 'checkpoints.json')):
+            with open(os.path.join(run_path, 'checkpoints.json'), 'r') as fp:
+                index = json.load(fp)
+        
+        metrics = {}
+        extra_path = os.path.join(run_path, 'EXTRAhistory.json')
+        if os.path.isfile(extra_path):
+            with open(extra_path, 'r') as fp:
+                extraHistory = json.load(fp)
+            for name, values in extraHistory.items():
+                for episode, value in enumerate(values):
+                    metrics.setdefault(episode, {})[name.replace("_lst","")] = value
+        history, saved = {}, []
+        histories = [e for e in sorted(checkpoints) if os.path.isfile(os.path.join(run_path, "e{}".format(e), 'history.json'))]
+        if os.path.isfile(os.path.join(run_path, 'history.json')):
+            with open(os.path.join(run_path, 'history.json'), 'r') as fp:
+                history = json.load(fp)
+            saved = history.pop("episode", [])
+        elif histories:
+            with open(os.path.join(run_path, "e{}".format(histories[-1]), 'history.json'), 'r') as fp:
+                history = json.load(fp)
+            n = max(len(values) for values in history.values())
+            saved = sorted(checkpoints)[:n]
+            if len(saved) < n or saved[-1] != histories[-1]:
+                print("WARNING: checkpoints of {} have been removed, the saved episodes of its history are unknown and it is not imported".format(run_path))
+                saved = []
+        for name, values in history.items():
+            for episode, value in zip(saved, values):
+                metrics.setdefault(episode, {})[name] = value
+        
+        self._insert_metrics(run_id, metrics)
+        for episode, (checkpoint_format, path) in checkpoints.items():
+            metric = index.get("e{}".format(episode), {}).get("metric")
+            if metric is None:
+                metric = metrics.get(episode, {}).get("validation_profit")
+            self.log_checkpoint(run_path, episode, checkpoint_format, path, metric)
+        print("Succesfully imported run {0} ({1} episodes with metrics, {2} checkpoints)".format(run_path, len(metrics), len(checkpoints)))
+        return run_id
+    
+    def import_runs(self, root: str) -> list:
+        '''
+        Imports every run folder (folder with agent_parameters.json) below root
+        '''
+        run_ids = []
+        for path, dirs, files in os.walk(root):
+            if 'agent_parameters.json' in files:
+                run_ids.append(self.import_run(path))
+        return run_ids
+    
+    def query(self, sql: str, args = []) -> pd.DataFrame:
+        with self.connect() as con:
+            return pd.read_sql_query(sql, con, params = args)
+    
+    def get_runs(self, keys = None) -> pd.DataFrame:
+        '''
+        Table with one row per run and (the given) hyperparameters as columns
+        '''
+        table = self.query("SELECT runs.run_id, runs.name, runs.path, params.key, params.value_num, params.value_text "
+                           "FROM runs JOIN params ON runs.run_id = params.run_id")
+        if keys is not None:
+            table = table[table.key.isin(keys)]
+        table["value"] = table.value_num.where(table.value_num.notna(), table.value_text)
+        return table.pivot_table(index = ["run_id","name","path"], columns = "key", values = "value", 
+                                 aggfunc = "first").reset_index()
+    
+    def best_by(self, param: str, metric = "validation_profit", maximize = True) -> pd.DataFrame:
+        '''
+        Best metric (and the run and episode attaining it) per value of a 
+        hyperparameter, e.g. best_by("hold_scale", "validation_profit")
+        '''
+        order = "DESC" if maximize else "ASC"
+        sql = '''
+            SELECT value, metric, run_id, name, episode FROM (
+                SELECT COALESCE(p.value_num, p.value_text) AS value, m.value AS metric, m.run_id, runs.name, m.episode,
+                       ROW_NUMBER() OVER (PARTITION BY COALESCE(p.value_num, p.value_text) ORDER BY m.value {0}) AS rank
+                FROM metrics m 
+                JOIN params p ON p.run_id = m.run_id AND p.key = ?
+                JOIN runs ON runs.run_id = m.run_id
+                WHERE m.name = ?)
+            WHERE rank = 1 ORDER BY metric {0}
+        '''.format(order)
+        table = self.query(sql, [param, metric])
+        return table.rename(columns = {"value":param, "metric":metric})
@@ -0,0 +1,359 @@
+'''
+Streaming state builder and the asyncio policy server for live price feeds
+'''
+import numpy as np
+from collections import deque
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from utility import UtilFuncs, Statistics
+except ImportError:
+    from AE4350_Assignment.utility import UtilFuncs, Statistics
+try:
+    from evaluation import PolicyAgent, Portfolio
+except ImportError:
+    from AE4350_Assignment.evaluation import PolicyAgent, Portfolio
+
+#%% Streaming state
+class StreamingState:
+    '''
+    Incremental counterpart of UtilFuncs.get_state for live price feeds. 
+    For every symbol a ring buffer holds the last stateTS_size scaled returns,
+    which is updated in O(1) per new price instead of recomputing the entire
+    window from the full price history.
+    
+    Every ring is stored twice after each other such that the current window 
+    is always available as a contiguous view, i.e. the time series part of 
+    the state is emitted without copying. The portfolio part of the state 
+    (6 features) is computed by UtilFuncs.get_utilState.
+    '''
+    def __init__(self, stateTS_size: int, tanh_scale: float, n_symbols = 1, mask_input = False):
+        self.stateTS_size = stateTS_size
+        self.tanh_scale = tanh_scale
+        self.n_symbols = n_symbols
+        self.mask_input = mask_input
+        self.reset()
+    
+    def reset(self, symbols = None):
+        '''
+        Clears the history of the given (default all) symbols
+        '''
+        if symbols is None:
+            self.buffer = np.zeros((self.n_symbols, 2*self.stateTS_size))
+            self.pos = np.zeros(self.n_symbols, dtype = int) # position of the oldest return
+            self.last_price = np.full(self.n_symbols, np.nan)
+        else:
+            self.buffer[symbols] = 0.
+            self.pos[symbols] = 0
+            self.last_price[symbols] = np.nan
+            
+    def update(self, prices, symbols = None):
+        '''
+        Adds the newest price of the given (default all) symbols. The first 
+        price of a symbol only initializes it, which is equivalent to the 
+        constant padding at the start of the data in get_state
+        '''
+        if symbols is None:
+            symbols = np.arange(self.n_symbols)
+        symbols = np.atleast_1d(symbols)
+        prices = np.atleast_1d(np.asarray(prices, dtype = float))
+        
+        started = ~np.isnan(self.last_price[symbols])
+        rows = symbols[started]
+        returns = np.tanh((prices[started]-self.last_price[rows])/self.tanh_scale)
+        pos = self.pos[rows]
+        self.buffer[rows,pos] = returns
+        self.buffer[rows,pos+self.stateTS_size] = returns
+        self.pos[rows] = (pos+1) % self.stateTS_size
+        self.last_price[symbols] = prices
+    
+    def get_window(self, symbol = 0) -> np.array:
+        '''
+        Returns the scaled returns of the symbol (oldest first) as a view
+        '''
+        pos = self.pos[symbol]
+        return self.buffer[symbol, pos:pos+self.stateTS_size]
+    
+    def get_state(self, agent, n_holds: int, tradeCost: float, symbol = 0):
+        '''
+        Returns the state of a symbol as [states_ts, states_ut], i.e. the two 
+        inputs of the actor. states_ts is a view on the ring buffer unless 
+        mask_input is used, agent can be any object holding the portfolio 
+        attributes (balance, inventory, inventory_conj, max_holds)
+        '''
+        window = self.get_window(symbol)
+        if self.mask_input:
+            masked = np.zeros(self.stateTS_size)
+            masked[min(-1,-min(n_holds,self.stateTS_size+1)):] = window[min(-1,-min(n_holds,self.stateTS_size+1)):]
+            window = masked
+        states_ts = window.reshape(1,self.stateTS_size,1)
+        price = self.last_price[symbol]
+        states_ut = np.array([UtilFuncs.get_utilState(agent, price, n_holds, tradeCost)])
+        return [states_ts, states_ut]
+    
+    def get_fullState(self, agent, n_holds: int, tradeCost: float, symbol = 0) -> np.array:
+        '''
+        Returns the state in the layout of UtilFuncs.get_state, i.e. of shape
+        (1,stateTS_size+6,1), notice this does copy the window
+        '''
+        states_ts, states_ut = self.get_state(agent, n_holds, tradeCost, symbol = symbol)
+        return np.concatenate([states_ts[0,:,0], states_ut[0]]).reshape(1,-1,1)
+    
+    def get_windows(self, symbols = None) -> np.array:
+        '''
+        Returns the windows of multiple symbols as one (n,stateTS_size,1) array
+        for batched inference, notice this gathers (copies) the windows
+        '''
+        if symbols is None:
+            symbols = np.arange(self.n_symbols)
+        symbols = np.atleast_1d(symbols)
+        index = self.pos[symbols][:,None]+np.arange(self.stateTS_size)[None,:]
+        return self.buffer[symbols[:,None], index][:,:,None]
+    
+    def verify(self, agent, data: np.array, symbol = 0, n_holds = 0, tradeCost = 0.) -> float:
+        '''
+        Streams the data through the given symbol and compares every state 
+        with UtilFuncs.get_state, returns the maximum absolute difference
+        '''
+        self.reset([symbol])
+        max_error = 0.
+        for t in range(len(data)):
+            self.update(data[t], symbols = symbol)
+            utils_state = [len(data)-1, n_holds, 0, tradeCost, self.tanh_scale]
+            state = UtilFuncs.get_state(agent, data, t, self.stateTS_size+1, utils_state)
+            stream = self.get_fullState(agent, n_holds, tradeCost, symbol = symbol)
+            max_error = max(max_error, np.max(np.abs(state-stream)))
+        return max_error
+
+
+#%% Policy serving
+class PolicyServer:
+    '''
+    Local asyncio service which serves a trained actor to many accounts 
+    (portfolios) at once. Concurrent requests are coalesced into micro-batches,
+    a batch is run as soon as it is full (max_batch) or when the oldest 
+    request has waited for the latency budget (max_latency, seconds).
+    
+    Accounts can either submit a complete state (submit_state), or a new price
+    (submit_price) in which case the server builds the state with a 
+    StreamingState, maps the greedy action to buy/sell as Agent.take_action 
+    does and books the trade on the account's portfolio with handle_action.
+    The ticks of an account are counted, only the last max_indices trade 
+    indices (buy_ind, sell_ind, ...) are kept in its Statistics.
+    
+    Usage:
+        async with PolicyServer(agentParams, checkpoint_dir, episode) as server:
+            server.add_account("acc1", history = data_val[:window_size])
+            action, action_prob = await server.submit_price("acc1", price)
+    '''
+    def __init__(self, agentParams: dict, checkpoint_dir = None, episode = None, 
+                 tanh_scale = "test_tanh", max_batch = 256, max_latency = 0.002, 
+                 max_accounts = 1024, extraCash = 0., max_indices = 10000):
+        self.policy = PolicyAgent(agentParams)
+        if checkpoint_dir is not None:
+            self.policy.load_actor(checkpoint_dir, episode)
+        if isinstance(tanh_scale, str):
+            tanh_scale = agentParams[tanh_scale]
+        self.agentParams = agentParams
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.extraCash = extraCash
+        self.max_indices = max_indices
+        self.streams = StreamingState(self.policy.stateTS_size, tanh_scale, 
+                                      n_symbols = max_accounts, mask_input = self.policy.mask_input)
+        self.accounts = {}
+        self.executor = None
+        self.requests = None
+        self.batcher = None
+        self.reset_counters()
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, *args):
+        await self.stop()
+    
+    async def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers = 1) # model calls off the event loop
+        self.requests = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self._run_batcher())
+        self.start_time = time.perf_counter()
+    
+    async def stop(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+            self.batcher = None
+        if self.executor is not None:
+            self.executor.shutdown(wait = True)
+            self.executor = None
+    
+    '''
+    ============================ ACCOUNTS ====================================
+    '''
+    def add_account(self, name: str, history = None):
+        '''
+        Registers an account, history contains the prices preceding the first
+        traded price (at least stateTS_size prices for a complete window)
+        '''
+        if name in self.accounts:
+            raise Exception("Account {} already exists".format(name))
+        if len(self.accounts) >= self.streams.n_symbols:
+            raise Exception("Maximum amount of accounts reached, increase max_accounts")
+        slot = len(self.accounts)
+        self.streams.reset([slot])
+        if history is not None:
+            for price in history:
+                self.streams.update(price, symbols = slot)
+        stats = Statistics(None, training = False)
+        stats.reset_episode()
+        self.accounts[name] = {"slot":slot,
+                               "portfolio":Portfolio(self.agentParams),
+                               "stats":stats,
+                               "started":False,
+                               "tick":0,
+                               "lock":asyncio.Lock()}
+        return self.accounts[name]
+        
+    async def submit_state(self, states_ts, states_ut):
+        '''
+        Returns the mapped greedy action and action probabilities for a single
+        state, the buy/sell mapping uses the holding feature of the state
+        '''
+        action_prob = await self._infer(states_ts, states_ut)
+        action = int(np.argmax(action_prob[0]))
+        if action == 1 and states_ut[0,2] > 0:
+            action = 2 # sell, since a stock is held
+        return action, action_prob
+    
+    async def submit_price(self, name: str, price: float):
+        '''
+        Processes a new price of an account: updates its state, obtains the 
+        action from the next micro-batch and books it on the portfolio
+        '''
+        account = self.accounts[name]
+        async with account["lock"]: # keeps the updates of an account in order
+            portfolio = account["portfolio"]
+            stats = account["stats"]
+            if not account["started"]:
+                portfolio.reset(price)
+                portfolio.balance += self.extraCash
+                stats.extraCash += self.extraCash
+                account["started"] = True
+            self.streams.update(price, symbols = account["slot"])
+            states_ts, states_ut = self.streams.get_state(portfolio, stats.n_holds, 
+                                                          portfolio.trade_cost, symbol = account["slot"])
+            action_prob = await self._infer(states_ts, states_ut)
+            action = portfolio.map_action(np.argmax(action_prob[0]))
+            flags = [True, False]
+            t = account["tick"]
+            action, profit, impossible, _, _ = UtilFuncs.handle_action(portfolio, stats, action, None, t, flags, 
+                                                                       [action_prob], training = False, price = price)
+            account["tick"] += 1
+            for indices in [stats.buy_ind, stats.sell_ind, stats.imp_ind, stats.xtr_ind]:
+                if len(indices) > self.max_indices:
+                    del indices[:len(indices)-self.max_indices] # also correct for max_indices = 0
+        return action, action_prob
+    
+    async def serve_feed(self, feed) -> dict:
+        '''
+        Serves all ticks of a price feed (e.g. LocalPriceFeed), the accounts of
+        a tick are processed concurrently. Returns the actions per account
+        '''
+        actions = {}
+        async for tick in feed:
+            names = list(tick.keys())
+            results = await asyncio.gather(*[self.submit_price(name, tick[name]) for name in names])
+            for name, result in zip(names, results):
+                actions.setdefault(name, []).append(result[0])
+        return actions
+    
+    '''
+    ============================ BATCHING ====================================
+    '''
+    async def _infer(self, states_ts, states_ut) -> np.array:
+        if self.batcher is None:
+            raise Exception("Server is not running, call start first")
+        future = asyncio.get_running_loop().create_future()
+        await self.requests.put([np.asarray(states_ts, dtype = np.float32), 
+                                 np.asarray(states_ut, dtype = np.float32),
+                                 future, time.perf_counter()])
+        return await future
+    
+    async def _run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.requests.get()]
+            deadline = loop.time()+self.max_latency
+            while len(batch) < self.max_batch:
+                if not self.requests.empty():
+                    batch.append(self.requests.get_nowait())
+                    continue
+                timeout = deadline-loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.requests.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                    
+            states_ts = np.concatenate([request[0] for request in batch])
+            states_ut = np.concatenate([request[1] for request in batch])
+            try:
+                actions_prob = await loop.run_in_executor(self.executor, self.policy.predict, states_ts, states_ut)
+            except Exception as error:
+                for request in batch:
+                    if not request[2].done():
+                        request[2].set_exception(error)
+                continue
+            
+            now = time.perf_counter()
+            for i, request in enumerate(batch):
+                if not request[2].done():
+                    request[2].set_result(actions_prob[i:i+1])
+                self.latencies.append(now-request[3])
+            self.n_requests += len(batch)
+            self.n_batches += 1
+    
+    def reset_counters(self):
+        self.n_requests = 0
+        self.n_batches = 0
+        self.latencies = deque(maxlen = 10000) # most recent request latencies
+        self.start_time = time.perf_counter()
+        
+    def get_counters(self) -> dict:
+        '''
+        Returns the latency (seconds) and throughput counters of the server
+        '''
+        latencies = np.array(self.latencies) if len(self.latencies) else np.zeros(1)
+        elapsed = max(1e-12,time.perf_counter()-self.start_time)
+        return {"requests":self.n_requests,
+                "batches":self.n_batches,
+                "mean_batch":self.n_requests/max(1,self.n_batches),
+                "latency_mean":float(np.mean(latencies)),
+                "latency_p50":float(np.percentile(latencies,50)),
+                "latency_p99":float(np.percentile(latencies,99)),
+                "throughput":self.n_requests/elapsed}
+    
+
+class LocalPriceFeed:
+    '''
+    Local stand-in for a live price feed, replays price series of multiple 
+    accounts as ticks ({account: price}) with an optional interval (seconds)
+    '''
+    def __init__(self, prices: dict, interval = 0.):
+        self.prices = prices
+        self.interval = interval
+    
+    async def __aiter__(self):
+        length = max(len(self.prices[name]) for name in self.prices)
+        for t in range(length):
+            yield {name: self.prices[name][t] for name in self.prices if t < len(self.prices[name])}
+            if self.interval:
+                await asyncio.sleep(self.interval)
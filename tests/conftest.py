@@ -0,0 +1,83 @@
+import os
+import sys
+import copy
+import numpy as np
+import pytest
+
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tensorflow as tf
+tf.keras.utils.disable_interactive_logging()
+
+MODEL_HYPER = {"actor_ts_dLayers":[16,8], "actor_util_dLayers":[], "actor_comb_dLayers":[8], 
+               "actor_regularizer":1e-6, "critic_ts_dLayers":[16,8], "critic_util_dLayers":[], 
+               "critic_comb_dLayers":[8], "critic_action_dLayers":[], "critic_final_dLayers":[8], 
+               "critic_regularizer":1e-6, "use_batchNorm_tsdense":True, "use_dropout_tsdense":False, 
+               "ts_dropoutProb":0.2}
+AGENT_PARAMS = {"stateTS_size":16, "stateUT_size":6, "batch_size":16, "buffer_size":512, "data_extraWindow":0,
+                "n_budget":1, "is_terminal_threshold":1000, "model_hyper":MODEL_HYPER, "train_tanh":1.,
+                "vali_tanh":1.2, "test_tanh":1.5, "gamma":0.99, "tau":0.01, "mask_input":False, 
+                "subset_training":True, "subset_window":40}
+REWARD_PARAMS = {"rewardType":7, "penalty":0, "hold_scale":17, "trade_scale":14, "trade_cost":0, 
+                 "max_holds":100, "prob_power":1}
+EXTRA_PARAMS = {"EXTRACASH":0, "EXPAND":10, "LAST":5, "PROFITDIFF":200, "EXPAND_TIMER":10,
+                "TRADECOST_ACTUAL":1, "START_OFFSET":20, "VALI_EC":0, "SCRIPT_VERSION":17, "SEED":10}
+
+
+def randomize_actor(actor, seed = 0, scale = 1.):
+    '''
+    Random kernels for the actor, such that the greedy policy trades
+    '''
+    rng = np.random.default_rng(seed)
+    actor.model.set_weights([scale*rng.normal(size = w.shape) if w.ndim == 2 else w 
+                             for w in actor.model.get_weights()])
+
+
+def fill_buffer(agent, n, seed = 0):
+    '''
+    Random transitions in the replay buffer of the agent
+    '''
+    rng = np.random.default_rng(seed)
+    state_size = agent.stateTS_size+agent.stateUT_size
+    for i in range(n):
+        agent.memory.add_sample(rng.normal(size = (state_size,1)), rng.dirichlet([1,1]), rng.normal(), 
+                                rng.normal(size = (state_size,1)), False, time_index = i)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # checkpoint folders are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def prices():
+    rng = np.random.default_rng(0)
+    return 100+np.cumsum(rng.normal(0, 1, 400))
+
+
+@pytest.fixture
+def agent_params():
+    params = copy.deepcopy(AGENT_PARAMS)
+    params.update(REWARD_PARAMS)
+    params.update(EXTRA_PARAMS)
+    return params
+
+
+@pytest.fixture
+def make_agent(workdir, prices):
+    from utility import Agent
+    agents = []
+    def factory(checkpoint_dir = "run", seed = 0, **params):
+        agentParams = copy.deepcopy(AGENT_PARAMS)
+        agentParams.update(params)
+        agent = Agent(agentParams, prices[agentParams["stateTS_size"]], checkpoint_dir, 
+                      dict(REWARD_PARAMS), dict(EXTRA_PARAMS))
+        randomize_actor(agent.actor_local, seed)
+        agents.append(agent)
+        return agent
+    yield factory
+    for agent in agents:
+        agent.close()
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from utility import UtilFuncs, Statistics
+from evaluation import PolicyAgent, BatchBacktester, PathGenerator, MonteCarloStress
+
+
+def get_policy(agent):
+    policy = PolicyAgent(agent.attr_dct)
+    policy.actor_local.model.set_weights(agent.actor_local.model.get_weights())
+    return policy
+
+
+def evaluate(policy, data, extraCash):
+    W = policy.stateTS_size
+    stats = Statistics("run", training = False)
+    stats.reset_all(data[W], data[W:-1]-data[W])
+    UtilFuncs.evaluate_policy(policy, stats, data, W, policy.vali_tanh, extraCash = extraCash)
+    return stats
+
+
+@pytest.mark.parametrize("mask_input, extraCash", [[False, 0.], [False, 50.], [True, 0.]])
+def test_backtester_matches_evaluate_policy(make_agent, prices, mask_input, extraCash):
+    policy = get_policy(make_agent(mask_input = mask_input))
+    paths = np.stack([prices[:100], prices[100:200], prices[250:350]])
+    results = BatchBacktester(policy, "vali_tanh", extraCash = extraCash).run(paths, keep_actions = True)
+    for i, data in enumerate(paths):
+        stats = evaluate(policy, data, extraCash)
+        assert results["actions"][i].tolist() == stats.actions
+        assert results["profit"][i] == pytest.approx(stats.growth[-1])
+        assert results["profit_diff"][i] == pytest.approx(stats.compete[-1])
+        assert [results["n_trades"][i], results["n_impossible"][i], results["n_posiProfits"][i]] == \
+               [stats.n_trades, stats.n_impossible, stats.n_posiProfits]
+        assert results["extraCash"][i] == pytest.approx(stats.extraCash)
+    assert results["n_trades"].sum() > 0
+
+
+def test_path_generator(prices):
+    generator = PathGenerator(prices, seed = 0)
+    for paths in [generator.gbm(5, 30), generator.block_bootstrap(5, 30, block_size = 7), 
+                  generator.regime_switching(5, 30)]:
+        assert paths.shape == (5, 30)
+        assert np.all(paths[:,0] == prices[-1]) and np.all(paths > 0)
+    # the bootstrap is built from blocks of the historical log returns
+    paths = generator.block_bootstrap(3, 15, block_size = 7)
+    historical = set(np.round(generator.log_returns, 10))
+    assert set(np.round(np.diff(np.log(paths), axis = 1).ravel(), 10)) <= historical
+
+
+def test_monte_carlo_stress(make_agent, prices):
+    policy = get_policy(make_agent())
+    stress = MonteCarloStress(policy, prices, seed = 0)
+    results = stress.run(n_paths = 10, horizon = 30, method = "bootstrap", chunk = 4)
+    assert len(results) == 10 and (results["method"] == "bootstrap").all()
+    summary = stress.summarize(results)
+    assert summary.loc["mean", "profit"] == pytest.approx(results["profit"].mean())
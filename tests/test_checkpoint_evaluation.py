@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from utility import UtilFuncs, Statistics
+from evaluation import PolicyAgent, CheckpointEvaluator
+
+
+def notebook_validation(agent, stats, data, window_size, tanh_scale, extraCash = 0.):
+    # the former validation loop of the main notebook
+    l = len(data)-1
+    stats.reset_episode()
+    stats.extraCash += extraCash
+    agent.is_eval = True
+    agent.reset(data[window_size])
+    agent.balance += extraCash
+    actions = []
+    for t in range(window_size,l):
+        utils_state = [l, stats.n_holds,stats.n_trades, agent.trade_cost, tanh_scale]
+        state = UtilFuncs.get_state(agent, data, t, window_size + 1, utils_state)
+        action, action_prob = agent.take_action(state, [0., data[t]])
+        action, profit,  impossible, _, _ = UtilFuncs.handle_action(agent, stats, action, data, 
+                                                                    t, [True, False], [action_prob], training = False)
+        stats.collect_iteration(agent,[profit, 0., 0., action, t-window_size])
+        actions.append(int(action))
+    return actions
+
+
+def new_stats(data, window_size):
+    stats = Statistics("run", training = False)
+    stats.reset_all(data[window_size], data[window_size:-1]-data[window_size])
+    return stats
+
+
+@pytest.mark.parametrize("extraCash", [0., 50.])
+def test_evaluate_policy_matches_notebook_loop(make_agent, prices, extraCash):
+    agent = make_agent()
+    data = prices[:100]
+    W = agent.stateTS_size
+    reference = new_stats(data, W)
+    actions = notebook_validation(agent, reference, data, W, agent.vali_tanh, extraCash)
+    stats = new_stats(data, W)
+    record = {"actions":[], "probs":[]}
+    UtilFuncs.evaluate_policy(agent, stats, data, W, agent.vali_tanh, extraCash = extraCash, record = record)
+    
+    assert reference.n_trades > 0
+    assert record["actions"] == actions
+    assert stats.growth == reference.growth
+    assert stats.compete == reference.compete
+    assert (stats.n_trades, stats.n_impossible, stats.extraCash) == \
+           (reference.n_trades, reference.n_impossible, reference.extraCash)
+
+
+def test_policy_agent_matches_agent(make_agent, prices):
+    agent = make_agent()
+    data = prices[:100]
+    W = agent.stateTS_size
+    reference = UtilFuncs.evaluate_policy(agent, new_stats(data, W), data, W, agent.vali_tanh)
+    policy = PolicyAgent(agent.attr_dct)
+    policy.actor_local.model.set_weights(agent.actor_local.model.get_weights())
+    stats = UtilFuncs.evaluate_policy(policy, new_stats(data, W), data, W, agent.vali_tanh)
+    assert stats.actions == reference.actions
+    assert stats.growth[-1] == pytest.approx(reference.growth[-1])
+
+
+@pytest.mark.parametrize("checkpoint_format", ["h5", "npz"])
+def test_checkpoint_evaluator_matches_evaluate_policy(make_agent, prices, checkpoint_format):
+    agent = make_agent(checkpoint_format = checkpoint_format)
+    W = agent.stateTS_size
+    datasets = {"validation":[prices[:90], "vali_tanh"], "test":[prices[60:150], 1.5]}
+    expected = {}
+    for episode, seed in [[1, 1], [2, 2]]:
+        agent.actor_local.model.set_weights([w+0.5*np.random.default_rng(seed).normal(size = w.shape) 
+                                             if w.ndim == 2 else w for w in agent.actor_local.model.get_weights()])
+        agent.save_models(episode)
+        for name, [data, tanh_scale] in datasets.items():
+            tanh_scale = agent.vali_tanh if tanh_scale == "vali_tanh" else tanh_scale
+            stats = UtilFuncs.evaluate_policy(agent, new_stats(data, W), data, W, tanh_scale)
+            expected[(episode, name)] = [stats.growth[-1], stats.compete[-1], stats.n_trades]
+    
+    evaluator = CheckpointEvaluator("run", datasets, n_workers = 1)
+    assert evaluator.find_checkpoints() == [1, 2]
+    serial = evaluator.evaluate()
+    evaluator.n_workers = 2
+    parallel = evaluator.evaluate()
+    assert serial.equals(parallel)
+    assert len(serial) == 4
+    for _, row in serial.iterrows():
+        assert [row["profit"], row["profit_diff"], row["n_trades"]] == \
+               pytest.approx(expected[(row["episode"], row["dataset"])])
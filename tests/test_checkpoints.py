@@ -0,0 +1,79 @@
+import os
+import json
+import numpy as np
+
+from utility import UtilFuncs
+from conftest import fill_buffer
+
+
+def saved_episodes(agent) -> list:
+    with open(os.path.join(agent.checkpoint_path, "checkpoints.json"), "r") as fp:
+        index = json.load(fp)
+    episodes = sorted(entry["episode"] for entry in index.values())
+    on_disk = sorted(int(name[1:].split(".")[0]) for name in os.listdir(agent.checkpoint_path) 
+                     if name[0] == "e" and name[1].isdigit())
+    assert episodes == on_disk
+    return episodes
+
+
+def test_keep_best_save_rate_prune(make_agent):
+    agent = make_agent(keep_best = 1)
+    agent.save_models(10)
+    assert saved_episodes(agent) == [10] # unrated, kept until validated
+    agent.set_checkpointMetric(10, 5.)
+    agent.save_models(20)
+    assert saved_episodes(agent) == [10, 20]
+    agent.set_checkpointMetric(20, 3.)
+    assert saved_episodes(agent) == [10]
+    agent.save_models(30)
+    agent.set_checkpointMetric(30, 7.)
+    assert saved_episodes(agent) == [30]
+
+
+def test_keep_last_and_best(make_agent):
+    agent = make_agent(keep_last = 2, keep_best = 1, checkpoint_format = "npz")
+    for episode, metric in [[1, 9.], [2, 1.], [3, 2.], [4, 0.]]:
+        agent.save_models(episode)
+        agent.set_checkpointMetric(episode, metric)
+    assert saved_episodes(agent) == [1, 3, 4]
+
+
+def test_keep_last_prunes_on_save(make_agent):
+    agent = make_agent(keep_last = 2)
+    for episode in [1, 2, 3]:
+        agent.save_models(episode)
+    assert saved_episodes(agent) == [2, 3]
+
+
+def test_history_survives_pruning(make_agent):
+    for checkpoint_format in ["h5", "npz"]:
+        agent = make_agent(checkpoint_dir = "run_" + checkpoint_format, keep_last = 1, 
+                           checkpoint_format = checkpoint_format)
+        history = {"validation_profit":[]}
+        for episode in [30, 60, 90]:
+            agent.save_models(episode)
+            history["validation_profit"].append(float(episode))
+            agent.save_history(episode, history)
+        assert saved_episodes(agent) == [90]
+        with open(os.path.join(agent.checkpoint_path, "history.json"), "r") as fp:
+            saved = json.load(fp)
+        assert saved == {"validation_profit":[30., 60., 90.], "episode":[30, 60, 90]}
+
+
+def test_npz_roundtrip(make_agent):
+    agent = make_agent(checkpoint_format = "npz")
+    fill_buffer(agent, 64)
+    for _ in range(3):
+        agent.learn_replayed(agent.memory.sample_batch(agent.batch_size))
+    agent.update_weights(agent.actor_target.model, agent.actor_local.model)
+    agent.save_models(5)
+    
+    other = make_agent("other", seed = 1)
+    other.load_models("run", 5)
+    for net in ["actor_local", "actor_target", "critic_local", "critic_target"]:
+        for a, b in zip(getattr(agent, net).model.get_weights(), getattr(other, net).model.get_weights()):
+            np.testing.assert_allclose(a, b, rtol = 0, atol = 1e-6)
+    for a, b in [[agent.actor_local.optimizer, other.actor_local.optimizer],
+                 [agent.critic_local.model.optimizer, other.critic_local.model.optimizer]]:
+        for x, y in zip(UtilFuncs.get_optimizerWeights(a), UtilFuncs.get_optimizerWeights(b)):
+            np.testing.assert_array_equal(x, y)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from utility import UtilFuncs, Statistics
+from evaluation import PolicyAgent, CostSensitivity
+
+COSTS = [0., 1., 5.]
+
+
+def get_policy(agent):
+    policy = PolicyAgent(agent.attr_dct)
+    policy.actor_local.model.set_weights(agent.actor_local.model.get_weights())
+    return policy
+
+
+def test_grid_matches_evaluate_policy(make_agent, prices):
+    policy = get_policy(make_agent())
+    data = prices[:150]
+    W = policy.stateTS_size
+    results = CostSensitivity(policy).run(data, COSTS)
+    assert results["cost"].tolist() == COSTS and (results["path"] == 0).all()
+    for cost, row in zip(COSTS, results.itertuples()):
+        policy.trade_cost = cost
+        policy.TRADECOST_ACTUAL = cost
+        stats = Statistics("run", training = False)
+        stats.reset_all(data[W], data[W:-1]-data[W])
+        UtilFuncs.evaluate_policy(policy, stats, data, W, policy.vali_tanh)
+        assert row.profit == pytest.approx(stats.growth[-1])
+        assert [row.n_trades, row.n_impossible] == [stats.n_trades, stats.n_impossible]
+
+
+def test_tradecost_actual_only_shifts_profit(make_agent, prices):
+    policy = get_policy(make_agent())
+    paths = np.stack([prices[:150], prices[200:350]])
+    sensitivity = CostSensitivity(policy)
+    results = sensitivity.run(paths, COSTS, vary = "tradecost_actual")
+    for path, table in results.groupby("path"):
+        assert table["n_trades"].nunique() == 1 # same actions for every cost
+        shift = table["profit"].to_numpy()-table["profit"].iloc[0]
+        np.testing.assert_allclose(shift, -np.array(COSTS)*table["n_trades"].iloc[0])
+    curve = sensitivity.get_curve(results)
+    assert curve.index.tolist() == COSTS
+    assert curve.loc[1., "profit"] == pytest.approx(results[results.cost == 1.]["profit"].mean())
+    with pytest.raises(Exception):
+        sensitivity.run(paths, COSTS, vary = "spread")
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from conftest import fill_buffer
+from evaluation import PolicyAgent, CheckpointEvaluator
+from distillation import PolicyDistiller
+
+
+def test_student_learns_teacher_policy(make_agent, prices):
+    agent = make_agent()
+    fill_buffer(agent, 200)
+    # the test teacher is smaller than the default student
+    distiller = PolicyDistiller(agent, student_hyper = {"actor_ts_dLayers":[8], "actor_comb_dLayers":[4]}, seed = 0)
+    assert distiller.student.actor_local.model.count_params() < agent.actor_local.model.count_params()
+    
+    datasets = {"train":[prices[:200], "train_tanh"]}
+    states = distiller.collect_states(agent.memory, datasets)
+    assert states.shape == (200+200-agent.stateTS_size-1, agent.stateTS_size+agent.stateUT_size, 1)
+    distiller.add_states(states)
+    before = distiller.score_states(*distiller.holdout)
+    history = distiller.fit(epochs = 30, batch_size = 64, learning_rate = 3e-3, verbose = False)
+    after = distiller.score_states(*distiller.holdout)
+    assert len(history) == 30 and history["loss"].iloc[-1] < history["loss"].iloc[0]
+    assert after["kl"] < before["kl"] and after["agreement"] > before["agreement"]
+    
+    holdout = distiller.holdout[0]
+    n_train = len(distiller.train[0])
+    all_states = distiller.dagger(states[:10], datasets, rounds = 1, epochs = 1, verbose = False)
+    assert distiller.holdout[0] is holdout
+    assert len(distiller.train[0]) == n_train+10+len(states)-200 # plus the states visited by the student
+    assert len(all_states) == len(holdout)+len(distiller.train[0])
+
+
+def test_exported_student_is_a_regular_checkpoint(make_agent, prices):
+    agent = make_agent()
+    distiller = PolicyDistiller(agent, seed = 0)
+    distiller.fit(distiller.collect_states(datasets = {"train":[prices[:120], 1.]}), epochs = 2, verbose = False)
+    distiller.export("student", episode = 3)
+    with pytest.raises(Exception):
+        distiller.export("student")
+    
+    policy = PolicyAgent(distiller.studentParams)
+    policy.load_actor("student", 3)
+    states = distiller.holdout[0]
+    assert policy.predict(*distiller.split(states)) == pytest.approx(distiller.student.predict(*distiller.split(states)))
+    table = CheckpointEvaluator("student", {"validation":[prices[100:200], "vali_tanh"]}, n_workers = 1).evaluate()
+    report = distiller.report({"validation":[prices[100:200], "vali_tanh"]})
+    assert table["profit"].iloc[0] == pytest.approx(report.loc["validation", "student_profit"])
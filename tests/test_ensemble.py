@@ -0,0 +1,45 @@
+import copy
+import numpy as np
+import pytest
+
+from conftest import AGENT_PARAMS, REWARD_PARAMS, EXTRA_PARAMS
+from ensemble import EnsembleAgent
+
+
+@pytest.fixture
+def ensemble(workdir, prices):
+    params = copy.deepcopy(AGENT_PARAMS)
+    return EnsembleAgent(params, prices[params["stateTS_size"]], "ens", dict(REWARD_PARAMS), 
+                         dict(EXTRA_PARAMS), n_members = 2)
+
+
+def test_members_match_stacked_model(ensemble):
+    rng = np.random.default_rng(0)
+    states_ts = rng.normal(size = (2, 5, ensemble.stateTS_size, 1))
+    states_ut = rng.normal(size = (2, 5, ensemble.stateUT_size))
+    stacked = ensemble.predict(states_ts, states_ut)
+    for k in range(2):
+        member = ensemble.get_member(k).predict(states_ts[k], states_ut[k])
+        np.testing.assert_allclose(stacked[k], member, rtol = 1e-5, atol = 1e-6)
+
+
+def test_terminated_member_stores_final_transition(ensemble, prices):
+    W = ensemble.stateTS_size
+    calls = []
+    def check_threshold(utils, terminateFunc_on = False):
+        calls.append(1)
+        return len(calls) >= 3, "test"
+    ensemble.members[0].check_threshold = check_threshold # member 0 terminates at its third step
+    
+    stats = ensemble.get_statistics()
+    for s in stats:
+        s.reset_all(prices[W], np.zeros(len(prices)))
+    ensemble.run_episode(prices, W+5, W+25, stats, ensemble.train_tanh)
+    
+    terminated, finished = [member.memory for member in ensemble.members]
+    assert terminated.memory_counter == 3
+    assert terminated.memory_dones[:3].tolist() == [False, False, True]
+    assert finished.memory_counter == 20
+    assert finished.memory_dones[:20].tolist() == [False]*19+[True]
+    # the action probabilities are stored as the action
+    assert np.allclose(terminated.memory_action[:3].sum(axis = -1), 1., atol = 1e-5)
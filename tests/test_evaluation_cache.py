@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+from evaluation import PolicyAgent, EvaluationCache, CheckpointEvaluator, _evaluate_datasets
+
+
+def test_cached_evaluation_matches_fresh(make_agent, prices, workdir):
+    agent = make_agent()
+    datasets = {"validation":[prices[:90], "vali_tanh"], "test":[prices[60:150], 1.5]}
+    policy = PolicyAgent(agent.attr_dct)
+    policy.actor_local.model.set_weights(agent.actor_local.model.get_weights())
+    cache = EvaluationCache(str(workdir / "cache"))
+    
+    records = {}
+    expected = _evaluate_datasets(policy, agent.attr_dct, datasets, 3, records = records)
+    fresh = cache.evaluate(policy, agent.attr_dct, datasets, 3)
+    cached = cache.evaluate(policy, agent.attr_dct, datasets, 4)
+    assert [row.pop("cached") for row in fresh] == [False, False]
+    assert [row.pop("cached") for row in cached] == [True, True]
+    assert fresh == expected
+    for row in cached:
+        assert row.pop("episode") == 4
+    assert cached == [{k: v for k, v in row.items() if k != "episode"} for row in expected]
+    
+    entry = cache.get_actions(policy, agent.attr_dct, prices[:90], "vali_tanh")
+    assert entry["actions"].tolist() == records["validation"]["actions"]
+    assert entry["probs"] == pytest.approx(np.array(records["validation"]["probs"]), abs = 1e-6)
+
+
+def test_key_changes_with_inputs(make_agent, prices, workdir):
+    agent = make_agent()
+    cache = EvaluationCache(str(workdir / "cache"))
+    weights = agent.actor_local.model.get_weights()
+    key = cache.get_key(weights, prices[:90], 1., agent.attr_dct)
+    assert key == cache.get_key([w.copy() for w in weights], prices[:90].copy(), 1., dict(agent.attr_dct))
+    assert key != cache.get_key(weights, prices[:91], 1., agent.attr_dct)
+    assert key != cache.get_key(weights, prices[:90], 1.2, agent.attr_dct)
+    assert key != cache.get_key([w+1e-3 for w in weights], prices[:90], 1., agent.attr_dct)
+    assert key != cache.get_key(weights, prices[:90], 1., dict(agent.attr_dct, trade_cost = 0.5))
+    assert cache.get(key) is None
+
+
+def test_least_recently_used_entries_are_evicted(workdir):
+    cache = EvaluationCache(str(workdir / "cache"))
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, [0, 1, 2]*100, [0.5]*300, {"profit":float(i)})
+        os.utime(cache.get_path(key), (i, i))
+    assert cache.get("a")["row"] == {"profit":0.} # touches a, b is now the oldest
+    size = os.path.getsize(cache.get_path("a"))
+    cache.max_bytes = 2.5*size
+    assert cache.evict() == 1
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_checkpoint_evaluator_uses_cache(make_agent, prices):
+    agent = make_agent()
+    for episode in [1, 2]:
+        agent.actor_local.model.set_weights([w+0.1*episode for w in agent.actor_local.model.get_weights()])
+        agent.save_models(episode)
+    datasets = {"validation":[prices[:90], "vali_tanh"]}
+    reference = CheckpointEvaluator("run", datasets, n_workers = 1).evaluate()
+    evaluator = CheckpointEvaluator("run", datasets, n_workers = 1, cache_dir = "cache")
+    first = evaluator.evaluate()
+    second = evaluator.evaluate()
+    assert not first["cached"].any() and second["cached"].all()
+    assert first.drop(columns = "cached").equals(reference)
+    assert second.drop(columns = "cached").equals(reference)
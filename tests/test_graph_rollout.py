@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from utility import UtilFuncs, Statistics
+
+
+def new_stats(data, W):
+    stats = Statistics("run", training = True)
+    stats.reset_all(data[W], data[W:-1]-data[W])
+    stats.reset_episode()
+    return stats
+
+
+def python_rollout(agent, data, start, end, stats, tanh_scale):
+    # the iteration loop of the main notebook with the actor frozen
+    W, l = agent.stateTS_size, len(data)-1
+    agent.reset(data[start])
+    agent.balance += agent.EXTRACASH
+    stats.extraCash += agent.EXTRACASH
+    state = UtilFuncs.get_state(agent, data, start, W+1, [end, stats.n_holds, stats.n_trades, agent.trade_cost, tanh_scale])
+    for t in range(start, end):
+        action, action_prob = agent.take_action(state, [])
+        action, profit, impossible, terminate, _ = UtilFuncs.handle_action(agent, stats, action, data, t, 
+                                                                           [True, False], [action_prob])
+        done = t == end-1
+        utils_reward = [data[t], data[t-1], data[t+1], action, action_prob[0], stats.n_trades, stats.n_holds, 
+                        impossible, l, terminate]
+        reward = agent.get_reward(agent, profit, utils_reward, done)
+        stats.total_reward += reward
+        next_state = UtilFuncs.get_state(agent, data, t+1, W+1, [end, stats.n_holds, stats.n_trades, agent.trade_cost, tanh_scale])
+        agent.memory.add_sample(state, action_prob, reward, next_state, done)
+        state = next_state
+        stats.collect_iteration(agent, [profit, reward, agent.actor_local_loss, action, t-start])
+
+
+@pytest.mark.parametrize("mask_input, trade_cost", [[False, 0.], [False, 3.], [True, 3.]])
+def test_rollout_matches_python_loop(make_agent, prices, mask_input, trade_cost):
+    agents = [make_agent(checkpoint_dir = "py", mask_input = mask_input), 
+              make_agent(checkpoint_dir = "graph", mask_input = mask_input)]
+    for agent in agents:
+        agent.trade_cost = trade_cost
+        agent.EXTRACASH = trade_cost
+    reference, graph = agents
+    data = prices
+    W, start, end = reference.stateTS_size, 50, 250
+    stats_py, stats_graph = new_stats(data, W), new_stats(data, W)
+    
+    np.random.seed(5)
+    python_rollout(reference, data, start, end, stats_py, 1.)
+    np.random.seed(5)
+    graph.scheduler.warmup = 10**9 # transitions only, no learning steps
+    graph.rollout_episode(data, start, end, stats_graph, 1.)
+    
+    n = end-start
+    assert stats_py.n_trades > 0
+    assert stats_graph.actions == stats_py.actions
+    for key in ["n_trades", "n_impossible", "n_holds", "buy_ind", "sell_ind", "imp_ind"]:
+        assert getattr(stats_graph, key) == getattr(stats_py, key)
+    np.testing.assert_allclose(stats_graph.growth, stats_py.growth, atol = 1e-9)
+    assert stats_graph.total_reward == pytest.approx(stats_py.total_reward)
+    assert (graph.balance, graph.inventory, graph.inventory_conj) == \
+           pytest.approx((reference.balance, reference.inventory, reference.inventory_conj))
+    for name in ["memory_state", "memory_nextState", "memory_action", "memory_reward"]:
+        np.testing.assert_allclose(getattr(graph.memory, name)[:n], getattr(reference.memory, name)[:n], atol = 1e-5)
+    assert np.array_equal(graph.memory.memory_dones[:n], reference.memory.memory_dones[:n])
+
+
+def test_rollout_rejects_unsupported_settings(make_agent, prices):
+    agent = make_agent()
+    agent.rewardType = 1
+    with pytest.raises(Exception):
+        agent.rollout_episode(prices, 50, 100, new_stats(prices, agent.stateTS_size), 1.)
@@ -0,0 +1,43 @@
+import os
+import sys
+import json
+import subprocess
+
+from machine_profile import get_machineInfo, load_machineProfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_profile(path, **profile):
+    profile.setdefault("machine", get_machineInfo())
+    with open(path, "w") as fp:
+        json.dump(profile, fp)
+    return str(path)
+
+
+def run_python(code: str) -> str:
+    env = {key: value for key, value in os.environ.items() 
+           if key not in ["TF_ENABLE_ONEDNN_OPTS", "AE4350_IGNORE_PROFILE"]}
+    result = subprocess.run([sys.executable, "-c", code], cwd = ROOT, env = env, 
+                            capture_output = True, text = True, check = True)
+    return result.stdout.strip().splitlines()[-1]
+
+
+def test_profile_of_other_machine_is_ignored(tmp_path):
+    machine = dict(get_machineInfo(), node = "elsewhere")
+    path = write_profile(tmp_path/"profile.json", machine = machine, batch_size = 64)
+    assert load_machineProfile(path) == {}
+    path = write_profile(tmp_path/"profile.json", batch_size = 64)
+    assert load_machineProfile(path)["batch_size"] == 64
+
+
+def test_apply_before_tensorflow_import(tmp_path):
+    path = write_profile(tmp_path/"profile.json", intra_op_threads = 1, inter_op_threads = 2, 
+                         TF_ENABLE_ONEDNN_OPTS = "0")
+    code = ("import os, sys, machine_profile\n"
+            "imported = 'tensorflow' in sys.modules\n"
+            "machine_profile.apply_machineProfile({!r})\n"
+            "import tensorflow as tf\n"
+            "print(imported, os.environ['TF_ENABLE_ONEDNN_OPTS'], tf.config.threading.get_intra_op_parallelism_threads(),"
+            " tf.config.threading.get_inter_op_parallelism_threads())").format(path)
+    assert run_python(code) == "False 0 1 2"
@@ -0,0 +1,39 @@
+import sys
+import numpy as np
+
+from utility import UtilFuncs, Statistics
+from monitoring import MemoryMonitor
+
+
+def test_nbytes_sums_all_elements():
+    values = [1.5, "x"*1000, 2**100]
+    expected = sys.getsizeof(values)+sum(sys.getsizeof(value) for value in values)
+    assert MemoryMonitor.nbytes(values) == expected
+    
+    trace = [float(i) for i in range(100)]
+    array = np.zeros(50)
+    nested = {"a":trace, "b":trace, "c":[array]}
+    assert MemoryMonitor.nbytes(nested) == sys.getsizeof(nested)+3*sys.getsizeof("a")+MemoryMonitor.nbytes(trace) \
+                                           +sys.getsizeof(nested["c"])+array.nbytes
+
+
+def test_sample_trims_statistics(make_agent, prices):
+    agent = make_agent()
+    data = prices[:100]
+    W = agent.stateTS_size
+    stats = Statistics("run", training = False)
+    stats.reset_all(data[W], data[W:-1]-data[W])
+    for episode in range(3):
+        UtilFuncs.evaluate_policy(agent, stats, data, W, agent.vali_tanh)
+        stats.collect_episode(agent, episode, [])
+    
+    monitor = MemoryMonitor(agent, [stats], budgets = {"statistics":1}, action = "trim", trim_keep = 1, verbose = False)
+    before = monitor.report()
+    assert before["replay_buffer"] == sum(getattr(agent.memory, name).nbytes for name in 
+        ["memory_state", "memory_nextState", "memory_action", "memory_reward", "memory_dones", "memory_time"])
+    history = {}
+    report = monitor.sample(3, history)
+    assert report["trimmed"] == 2*8
+    assert report["statistics"] < before["statistics"]
+    assert list(stats.everyGrowth_dct.keys()) == ["buyhold", "e2"]
+    assert history["memory_statistics"] == [report["statistics"]/1e6]
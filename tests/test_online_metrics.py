@@ -0,0 +1,49 @@
+import json
+import numpy as np
+import pytest
+
+from utility import UtilFuncs, Statistics, OnlineMetrics
+
+
+def test_online_metrics_match_traces(make_agent, prices):
+    agent = make_agent()
+    data = prices[:150]
+    W = agent.stateTS_size
+    stats = Statistics("run", training = False)
+    stats.reset_all(data[W], data[W:-1]-data[W])
+    UtilFuncs.evaluate_policy(agent, stats, data, W, agent.vali_tanh)
+    m = stats.get_metrics()
+    
+    equity = stats.budget+np.array([0.]+stats.growth)
+    returns = np.diff(equity)/equity[:-1]
+    peak = np.maximum.accumulate(equity)
+    assert stats.n_trades > 0
+    assert m["return_mean"] == pytest.approx(np.mean(returns))
+    assert m["return_std"] == pytest.approx(np.std(returns, ddof = 1))
+    assert m["max_drawdown"] == pytest.approx(np.max((peak-equity)/peak))
+    assert m["n_trades"] == stats.n_trades
+    assert m["exposure"] == pytest.approx(np.mean(np.array(stats.inventories) > 0))
+
+
+def test_trade_statistics_count_roundtrips():
+    online = OnlineMetrics(100.)
+    # buy, sell (+5), hold, buy, sell (-2)
+    for growth, profit, holding, n_trades in [[0., 1., True, 1], [5., 5., False, 2], [5., 0., False, 2], 
+                                              [5., 3., True, 3], [3., -2., False, 4]]:
+        online.update(growth, profit, holding, n_trades)
+    m = online.summary()
+    assert m["n_trades"] == 4
+    assert m["n_roundtrips"] == 2
+    assert m["win_rate"] == 0.5
+    assert m["trade_mean"] == pytest.approx(1.5)
+    assert m["profit_factor"] == pytest.approx(2.5)
+    assert [m["best_trade"], m["worst_trade"]] == [5., -2.]
+
+
+def test_summary_is_valid_json():
+    online = OnlineMetrics(100.)
+    online.update(0., 0., True, 1)
+    online.update(4., 4., False, 2) # only winning round trips
+    m = online.summary()
+    assert m["profit_factor"] is None
+    assert json.loads(json.dumps(m, allow_nan = False)) == m
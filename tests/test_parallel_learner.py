@@ -0,0 +1,59 @@
+import warnings
+import numpy as np
+import pytest
+
+
+def fill_constant(agent, n, seed = 0):
+    # identical transitions, such that every shard is the same batch
+    rng = np.random.default_rng(seed)
+    state_size = agent.stateTS_size+agent.stateUT_size
+    state, next_state = rng.normal(size = (state_size,1)), rng.normal(size = (state_size,1))
+    for i in range(n):
+        agent.memory.add_sample(state, np.array([0.3,0.7]), 0.5, next_state, False, time_index = i)
+
+
+def get_models(agent) -> list:
+    return [agent.actor_local.model, agent.actor_target.model, agent.critic_local.model, agent.critic_target.model]
+
+
+def test_update_weights(make_agent):
+    agent = make_agent()
+    target, local = agent.critic_target.model, agent.critic_local.model
+    local.set_weights([w+1. for w in local.get_weights()])
+    expected = [(1-agent.tau)*t+agent.tau*l for t, l in zip(target.get_weights(), local.get_weights())]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        agent.update_weights(target, local)
+    for weight, value in zip(target.get_weights(), expected):
+        np.testing.assert_allclose(weight, value, rtol = 1e-6)
+
+
+def test_parallel_step_matches_serial_step(make_agent):
+    serial = make_agent(checkpoint_dir = "serial")
+    parallel = make_agent(checkpoint_dir = "parallel", parallel_learners = 2, parallel_calibration = 0)
+    for model, source in zip(get_models(parallel), get_models(serial)):
+        model.set_weights(source.get_weights())
+    for agent in [serial, parallel]:
+        fill_constant(agent, 64)
+    
+    serial.learn_replayed(serial.memory.sample_batch(16))
+    parallel.learn_steps(1, 16)
+    assert parallel.learner is not None
+    for model, reference in zip(get_models(parallel), get_models(serial)):
+        for weight, value in zip(model.get_weights(), reference.get_weights()):
+            np.testing.assert_allclose(weight, value, rtol = 1e-4, atol = 1e-5)
+    assert parallel.actor_local_loss == pytest.approx(float(serial.actor_local_loss), rel = 1e-4)
+
+
+def test_falls_back_to_serial_when_slower(make_agent):
+    agent = make_agent(parallel_learners = 1, parallel_calibration = 1)
+    fill_constant(agent, 64)
+    agent.learn_steps(3, 16)
+    learner = agent.get_parallelLearner()
+    assert learner.get_speedup() is None # one timed step of each path left
+    agent.learn_steps(1, 16)
+    if agent.learner is None:
+        assert agent.parallel_learners == 0
+        agent.learn_steps(1, 16) # continues with the single process path
+    else:
+        assert agent.learner.get_speedup() >= 1
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+
+from utility import UtilFuncs, Statistics, PlotRenderer
+
+
+def test_lttb_keeps_shape(prices):
+    x = np.arange(len(prices))
+    y = prices.copy()
+    y[123] += 50. # spike
+    ind = UtilFuncs.lttb(x, y, 40)
+    assert len(ind) == 40 and ind[0] == 0 and ind[-1] == len(y)-1
+    assert np.all(np.diff(ind) > 0)
+    assert 123 in ind
+    assert np.array_equal(UtilFuncs.lttb(x, y, len(y)+1), x)
+
+
+def test_downsample_and_thin_markers(prices):
+    x = np.arange(len(prices))
+    np.testing.assert_array_equal(UtilFuncs.downsample(x, prices, 0)[1], prices)
+    xs, ys = UtilFuncs.downsample(x, prices, 50)
+    assert len(xs) == 50 and np.array_equal(ys, prices[xs])
+    markers = np.arange(0, 300, 3)
+    thinned = UtilFuncs.thin_markers(markers, 10)
+    assert len(thinned) == 10 and thinned[0] == 0 and thinned[-1] == 297
+    assert np.array_equal(UtilFuncs.thin_markers(markers, 0), markers)
+
+
+def test_plot_figure_with_renderer(make_agent, prices):
+    agent = make_agent()
+    data = prices[:120]
+    W = agent.stateTS_size
+    stats = Statistics("run", training = False)
+    stats.reset_all(data[W], data[W:-1]-data[W])
+    UtilFuncs.evaluate_policy(agent, stats, data, W, agent.vali_tanh)
+    stats.collect_episode(agent, 1, [])
+    
+    stats.plot_figure(data, 1, [len(data)-1, W], max_points = 30)
+    with PlotRenderer(max_points = 30) as renderer:
+        stats.plot_figure(data, 2, [len(data)-1, W], renderer = renderer)
+    results = os.listdir(os.path.join("run", "results"))
+    assert "e1_TestTrades.html" in results and "e2_TestTrades.html" in results
+    assert not any(name.endswith(".plot.npz") for name in results) # snapshots removed after rendering
+    assert "plotly.min.js" in results # shared by the reports of the folder
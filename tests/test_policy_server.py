@@ -0,0 +1,49 @@
+import asyncio
+import numpy as np
+
+from utility import UtilFuncs, Statistics
+from serving import PolicyServer, LocalPriceFeed
+
+
+def serve(agent, data, n_accounts = 3, **kwargs):
+    W = agent.stateTS_size
+    async def main():
+        async with PolicyServer(agent.attr_dct, "run", 1, tanh_scale = "vali_tanh", **kwargs) as server:
+            for k in range(n_accounts):
+                server.add_account("acc{}".format(k), history = data[:W])
+            feed = LocalPriceFeed({"acc{}".format(k): data[W:len(data)-1] for k in range(n_accounts)})
+            actions = await server.serve_feed(feed)
+            return actions, server
+    return asyncio.run(main())
+
+
+def test_served_actions_match_evaluate_policy(make_agent, prices):
+    agent = make_agent()
+    agent.save_models(1)
+    data = prices[:120]
+    W = agent.stateTS_size
+    stats = Statistics("run", training = False)
+    stats.reset_all(data[W], data[W:-1]-data[W])
+    UtilFuncs.evaluate_policy(agent, stats, data, W, agent.vali_tanh)
+    
+    actions, server = serve(agent, data)
+    assert stats.n_trades > 0
+    for name, account in server.accounts.items():
+        assert actions[name] == stats.actions
+        assert account["stats"].n_trades == stats.n_trades
+        assert account["stats"].buy_ind == [t-W for t in stats.buy_ind]
+    assert server.get_counters()["requests"] == 3*(len(data)-1-W)
+
+
+def test_max_indices(make_agent, prices):
+    agent = make_agent()
+    agent.save_models(1)
+    data = prices[:120]
+    _, server = serve(agent, data, n_accounts = 1, max_indices = 0)
+    stats = server.accounts["acc0"]["stats"]
+    assert stats.n_trades > 0
+    assert stats.buy_ind == [] and stats.sell_ind == []
+    
+    _, server = serve(agent, data, n_accounts = 1, max_indices = 2)
+    stats = server.accounts["acc0"]["stats"]
+    assert len(stats.buy_ind) == min(2, stats.n_trades) and len(stats.sell_ind) <= 2
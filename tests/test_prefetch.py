@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from utility import BatchPrefetcher, ReplayBuffer
+from conftest import fill_buffer
+
+
+def test_sample_split_matches_sample_batch(make_agent):
+    agent = make_agent()
+    fill_buffer(agent, 100)
+    W = agent.stateTS_size
+    np.random.seed(0)
+    states, actions, rewards, next_states, dones = agent.memory.sample_batch(32)
+    np.random.seed(0)
+    batch = agent.memory.sample_split(32, W)
+    expected = [states[:,:W,:], states[:,W:,0], actions, rewards, next_states[:,:W,:], next_states[:,W:,0], dones]
+    for array, value in zip(batch, expected):
+        assert array.dtype == np.float32 and array.flags["C_CONTIGUOUS"]
+        np.testing.assert_array_equal(array, value)
+
+
+def test_learn_batch_matches_learn_replayed(make_agent):
+    agents = [make_agent(checkpoint_dir = "a"), make_agent(checkpoint_dir = "b")]
+    for name in ["actor_local", "actor_target", "critic_local", "critic_target"]:
+        getattr(agents[1], name).model.set_weights(getattr(agents[0], name).model.get_weights())
+    for agent in agents:
+        fill_buffer(agent, 100)
+    np.random.seed(1)
+    agents[0].learn_replayed(agents[0].memory.sample_batch(16))
+    np.random.seed(1)
+    agents[1].learn_batch(agents[1].memory.sample_split(16, agents[1].stateTS_size))
+    for name in ["actor_local", "critic_local", "critic_target"]:
+        for weight, value in zip(getattr(agents[1], name).model.get_weights(), getattr(agents[0], name).model.get_weights()):
+            np.testing.assert_allclose(weight, value, rtol = 1e-5, atol = 1e-6)
+
+
+def test_prefetcher_batches(make_agent):
+    agent = make_agent()
+    fill_buffer(agent, 100)
+    prefetcher = BatchPrefetcher(agent.memory, 8, agent.stateTS_size, depth = 2, seed = 0).start()
+    try:
+        batches = [prefetcher.get() for _ in range(5)]
+    finally:
+        prefetcher.stop()
+    assert [batch[0].shape for batch in batches] == [(8, agent.stateTS_size, 1)]*5
+    assert prefetcher.thread is None and prefetcher.queue.empty()
+    with pytest.raises(Exception):
+        prefetcher.get() # not running
+
+
+def test_prefetcher_raises_sampling_errors():
+    memory = ReplayBuffer(10, 2, 50, 8) # empty, sampling fails
+    prefetcher = BatchPrefetcher(memory, 8, 4, seed = 0).start()
+    with pytest.raises(ValueError):
+        prefetcher.get()
+    prefetcher.stop()
+
+
+def test_agent_prefetching(make_agent):
+    agent = make_agent(prefetch_batches = 2)
+    fill_buffer(agent, 100)
+    agent.learn_steps(3, 16)
+    assert agent.prefetcher is not None and agent.prefetcher.batch_size == 16
+    agent.learn_steps(1, 32) # batch size changed by the update schedule
+    assert agent.prefetcher.batch_size == 32
+    agent.evict_before(50) # prepared batches stem from the old buffer content
+    assert agent.prefetcher is None
@@ -0,0 +1,45 @@
+import os
+import json
+
+from registry import RunRegistry
+
+
+def metric_rows(registry, name) -> dict:
+    table = registry.query("SELECT episode, value FROM metrics WHERE name = ? ORDER BY episode", [name])
+    return dict(zip(table.episode.tolist(), table.value.tolist()))
+
+
+def test_import_pruned_run(make_agent, workdir):
+    agent = make_agent(keep_last = 1, checkpoint_format = "npz")
+    agent.save_attributes()
+    history = {"validation_profit":[]}
+    for episode in [0, 30, 60]: # pruned, and e0 breaks any interval inference
+        agent.save_models(episode)
+        history["validation_profit"].append(episode+1.)
+        agent.save_history(episode, history)
+        agent.set_checkpointMetric(episode, episode+1.)
+    
+    registry = RunRegistry(str(workdir/"runs.sqlite"))
+    registry.import_run("run")
+    assert metric_rows(registry, "validation_profit") == {0:1., 30:31., 60:61.}
+    checkpoints = registry.query("SELECT episode, format, metric FROM checkpoints")
+    assert checkpoints.values.tolist() == [[60, "npz", 61.]]
+
+
+def test_import_legacy_history(make_agent, workdir):
+    agent = make_agent()
+    agent.save_attributes()
+    for episode in [10, 20]:
+        agent.save_models(episode)
+    with open(os.path.join("run", "e20", "history.json"), "w") as fp:
+        json.dump({"validation_profit":[1., 2.]}, fp)
+    
+    registry = RunRegistry(str(workdir/"runs.sqlite"))
+    registry.import_run("run")
+    assert metric_rows(registry, "validation_profit") == {10:1., 20:2.}
+    
+    # with a removed checkpoint the episodes of the entries are unknown
+    os.rename(os.path.join("run", "e10"), os.path.join("run", "x10"))
+    registry = RunRegistry(str(workdir/"runs2.sqlite"))
+    registry.import_run("run")
+    assert metric_rows(registry, "validation_profit") == {}
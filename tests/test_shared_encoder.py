@@ -0,0 +1,52 @@
+import copy
+import numpy as np
+import pytest
+
+from conftest import MODEL_HYPER, fill_buffer
+
+NETWORKS = ["actor_local", "actor_target", "critic_local", "critic_target"]
+
+
+def copy_networks(source, agent):
+    for name in NETWORKS:
+        getattr(agent, name).model.set_weights(getattr(source, name).model.get_weights())
+
+
+def shared_hyper(encoder_gradients = "critic"):
+    return dict(copy.deepcopy(MODEL_HYPER), shared_ts_encoder = True, encoder_gradients = encoder_gradients)
+
+
+def test_learn_graph_matches_learn_batch(make_agent):
+    agents = [make_agent(checkpoint_dir = "a"), make_agent(checkpoint_dir = "b")]
+    copy_networks(*agents)
+    fill_buffer(agents[0], 64)
+    batch = agents[0].memory.sample_split(16, agents[0].stateTS_size)
+    agents[0].learn_batch(batch)
+    agents[1]._learn_graph(*batch)
+    for name in NETWORKS:
+        for weight, value in zip(getattr(agents[1], name).model.get_weights(), getattr(agents[0], name).model.get_weights()):
+            np.testing.assert_allclose(weight, value, rtol = 1e-4, atol = 1e-5)
+
+
+@pytest.mark.parametrize("encoder_gradients", ["critic", "both"])
+def test_shared_encoder(make_agent, encoder_gradients):
+    agent = make_agent(model_hyper = shared_hyper(encoder_gradients))
+    encoder = agent.encoder_local.model
+    encoder_refs = set(w.ref() for w in encoder.trainable_weights)
+    # one time series track for both networks
+    assert encoder_refs <= set(w.ref() for w in agent.actor_local.model.weights)
+    assert encoder_refs <= set(w.ref() for w in agent.critic_local.model.weights)
+    assert encoder_refs <= set(w.ref() for w in agent.critic_local.get_trainableWeights())
+    actor_refs = set(w.ref() for w in agent.actor_local.get_trainableWeights())
+    assert (encoder_refs <= actor_refs) == (encoder_gradients == "both")
+    targets = [target.ref() for target, _ in agent.soft_pairs]
+    assert len(targets) == len(set(targets)) # every shared weight is updated once
+    
+    fill_buffer(agent, 64)
+    before = [w.copy() for w in encoder.get_weights()]
+    target_before = [w.copy() for w in agent.encoder_target.model.get_weights()]
+    agent.learn_batch(agent.memory.sample_split(16, agent.stateTS_size))
+    after = encoder.get_weights()
+    assert any(not np.allclose(b, a) for b, a in zip(before, after)) # trained by the critic loss
+    for old, local, new in zip(target_before, after, agent.encoder_target.model.get_weights()):
+        np.testing.assert_allclose(new, (1-agent.tau)*old+agent.tau*local, rtol = 1e-5, atol = 1e-6)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from utility import Statistics
+from evaluation import PolicyAgent, SnapshotValidator, _evaluate_datasets
+
+
+def test_snapshots_are_scored_as_published(make_agent, prices):
+    agent = make_agent()
+    datasets = {"validation":[prices[100:200], "vali_tanh"]}
+    stats_val = Statistics("run", training = False)
+    stats_val.reset_all(prices[100], prices[100:200]-prices[100])
+    history = {}
+    expected = []
+    with SnapshotValidator(agent.attr_dct, datasets, max_pending = 1) as validator:
+        assert validator.publish(1, agent)
+        policy = PolicyAgent(agent.attr_dct)
+        policy.actor_local.model.set_weights(agent.actor_local.model.get_weights())
+        expected += _evaluate_datasets(policy, agent.attr_dct, datasets, 1)
+        # training continues, the published snapshot is not affected
+        agent.actor_local.model.set_weights([w+1. for w in agent.actor_local.model.get_weights()])
+        assert not validator.publish(2, agent) # the worker is still behind
+        validator.wait(history, {"validation": stats_val})
+    assert validator.skipped == [2]
+    assert validator.results == expected
+    assert history["validation_episode"] == [1]
+    assert history["validation_profit"] == [expected[0]["profit"]]
+    assert stats_val.validation_dct["e1"] == expected[0]
+
+
+def test_early_stopping(make_agent):
+    agent = make_agent()
+    validator = SnapshotValidator(agent.attr_dct, {"validation":[None, "vali_tanh"]}, patience = 2, min_delta = 0.5)
+    for episode, value in enumerate([1., 3., 3.2, 2., 4.]):
+        validator.collect([{"episode":episode, "dataset":"validation", "profit_diff":value, "profit":value,
+                            "n_posiProfits":0, "n_trades":0, "extraCash":0.}])
+        if validator.should_stop:
+            break
+    assert episode == 3 and validator.best_episode == 1 and validator.best_value == 3.
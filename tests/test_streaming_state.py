@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from serving import StreamingState
+
+
+@pytest.mark.parametrize("mask_input, n_holds", [[False, 0], [True, 5], [True, 40]])
+def test_streaming_state_matches_get_state(make_agent, prices, mask_input, n_holds):
+    agent = make_agent(mask_input = mask_input)
+    agent.reset(prices[0])
+    stream = StreamingState(agent.stateTS_size, agent.vali_tanh, mask_input = mask_input)
+    assert stream.verify(agent, prices[:80], n_holds = n_holds, tradeCost = 1.) < 1e-12
+
+
+def test_symbols_are_independent(prices):
+    stream = StreamingState(8, 2., n_symbols = 3)
+    series = [prices[:30], prices[100:130], prices[200:230]]
+    for t in range(30):
+        stream.update([s[t] for s in series])
+    windows = stream.get_windows()
+    for k, s in enumerate(series):
+        expected = np.tanh(np.diff(s)[-8:]/2.)
+        np.testing.assert_allclose(stream.get_window(k), expected)
+        np.testing.assert_allclose(windows[k,:,0], expected)
+    
+    window = stream.get_window(1)
+    assert np.shares_memory(window, stream.buffer) # a view, not a copy
+    stream.reset([1])
+    assert np.all(stream.get_window(1) == 0.) and np.isnan(stream.last_price[1])
+    np.testing.assert_allclose(stream.get_window(0), np.tanh(np.diff(series[0])[-8:]/2.))
@@ -0,0 +1,43 @@
+import numpy as np
+
+from utility import UpdateScheduler
+
+
+def run(scheduler, n_steps, memory_len = 1000) -> list:
+    steps = []
+    for _ in range(n_steps):
+        n_updates, batch_size = scheduler.step(memory_len)
+        scheduler.record_updates(n_updates, batch_size)
+        steps.append((n_updates, batch_size))
+    return steps
+
+
+def test_default_is_one_update_per_step():
+    scheduler = UpdateScheduler(32)
+    assert run(scheduler, 3, memory_len = 32) == [(0, 32)]*3 # buffer must exceed the batch size
+    assert run(scheduler, 3) == [(1, 32)]*3
+
+
+def test_cadence_warmup_and_phases():
+    scheduler = UpdateScheduler(32, train_every = 4, grad_steps = 2, warmup = 4,
+                                phases = [{"start":12, "train_every":1, "grad_steps":1, "batch_size":64}])
+    steps = run(scheduler, 14)
+    assert [n for n, _ in steps] == [0,0,0,0, 0,0,0,2, 0,0,0,1, 1,1]
+    assert [b for _, b in steps][-3:] == [64, 64, 64]
+    report = scheduler.report()
+    assert report["env_steps"] == 14 and report["grad_steps"] == 5
+    assert report["update_to_data"] == 5/14
+    assert report["replay_ratio"] == (2*32+3*64)/14
+    assert scheduler.report()["env_steps"] == 0 # reset by the previous report
+
+
+def test_agent_follows_schedule(make_agent):
+    agent = make_agent(update_schedule = {"train_every":3, "grad_steps":2})
+    calls = []
+    agent.learn_steps = lambda n_updates, batch_size: calls.append((n_updates, batch_size))
+    state_size = agent.stateTS_size+agent.stateUT_size
+    agent.last_state = np.zeros((state_size,1))
+    for t in range(agent.batch_size+6):
+        agent.take_step(np.array([[0.5,0.5]]), 0., np.zeros((state_size,1)), False)
+    assert sum(n for n, _ in calls) == 2*len([t for t in range(agent.batch_size+6) 
+                                               if t+1 > agent.batch_size and (t+1) % 3 == 0])
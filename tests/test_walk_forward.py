@@ -0,0 +1,42 @@
+import os
+import copy
+import numpy as np
+
+from utility import ReplayBuffer
+from evaluation import WalkForward
+from conftest import AGENT_PARAMS, REWARD_PARAMS, EXTRA_PARAMS
+
+
+def test_evict_before_wrapped_buffer():
+    memory = ReplayBuffer(3, 2, 10, 4)
+    for i in range(15): # wraps around, holds times 5..14
+        memory.add_sample(np.full((3,1), i), np.array([0.5,0.5]), float(i), np.zeros((3,1)), False, 
+                          time_index = i if i != 9 else -1)
+    assert memory.evict_before(8) == 3 # 5, 6 and 7
+    assert len(memory) == 7
+    assert memory.memory_time[:7].tolist() == [8, -1, 10, 11, 12, 13, 14] # unknown times are kept
+    assert memory.memory_reward[:7].ravel().tolist() == [8., 9., 10., 11., 12., 13., 14.]
+    assert np.all(memory.memory_time[7:] == -1)
+
+
+def test_walk_forward(workdir, prices):
+    params = dict(copy.deepcopy(AGENT_PARAMS), subset_window = 30)
+    walk = WalkForward(params, prices, "wf", dict(REWARD_PARAMS), dict(EXTRA_PARAMS), train_size = 120, 
+                       vali_size = 40, test_size = 40, step = 60, first_episodes = 2, fold_episodes = 1, 
+                       vali_every = 1, seed = 0)
+    folds = walk.get_folds()
+    assert folds[:2] == [[0, 120, 160, 200], [60, 180, 220, 260]]
+    assert all(fold[-1] < len(prices) for fold in folds)
+    
+    walk.run(n_folds = 1)
+    memory = walk.agent.memory
+    n_old = int(np.sum(memory.memory_time[:len(memory)] < 60))
+    results = walk.run(n_folds = 1)
+    walk.agent.close()
+    assert results.index.tolist() == [0, 1]
+    assert results["episodes"].tolist() == [2, 1]
+    # max_age 0: everything before the train window of the fold is evicted
+    assert results["evicted"].tolist() == [0, n_old]
+    assert np.all(memory.memory_time[:len(memory)] >= 60)
+    assert os.path.isfile(os.path.join("wf", "walkforward.csv"))
+    assert os.path.isdir(os.path.join("wf", "f0")) and os.path.isdir(os.path.join("wf", "f1"))
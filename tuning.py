@@ -0,0 +1,208 @@
+'''
+CPU performance auto-tuner, writes the machine profile
+
+Command line:
+    python tuning.py autotune <agent_parameters.json> [profile path]
+'''
+import tensorflow as tf 
+import numpy as np
+import math
+import os
+import pandas as pd
+import json
+import shutil
+import time
+import subprocess
+import sys
+import tempfile
+try:
+    from machine_profile import get_machineInfo, MACHINE_PROFILE
+except ImportError:
+    from AE4350_Assignment.machine_profile import get_machineInfo, MACHINE_PROFILE
+try:
+    from utility import Agent
+except ImportError:
+    from AE4350_Assignment.utility import Agent
+
+#%% Auto tuning
+def _run_calibration(config: dict) -> dict:
+    '''
+    Calibration benchmark of a single thread setting, runs in a fresh 
+    interpreter (see AutoTuner) as the thread pools and oneDNN can not be 
+    changed once tensorflow is running
+    '''
+    tf.config.threading.set_intra_op_parallelism_threads(config["intra_op_threads"])
+    tf.config.threading.set_inter_op_parallelism_threads(config["inter_op_threads"])
+    work_dir = tempfile.mkdtemp()
+    os.chdir(work_dir)
+    params = dict(config["agentParams"])
+    params.setdefault("rewardType", 0) # the reward function is not part of the benchmark
+    params.update({"batch_size":config["batch_size"], 
+                   "buffer_size":4*max(config["batch_sizes"]),
+                   "prefetch_batches":0, "parallel_learners":0, "update_schedule":{}, 
+                   "checkpoint_format":"h5", "keep_last":0, "keep_best":0})
+    agent = Agent(params, 100., "calibration", {}, {})
+    
+    rng = np.random.default_rng(0)
+    state_size = agent.stateTS_size+agent.stateUT_size
+    for _ in range(agent.memory.memory_size):
+        agent.memory.add_sample(rng.normal(size = (1,state_size,1)), rng.dirichlet([1,1]), rng.normal(), 
+                                rng.normal(size = (1,state_size,1)), False)
+    
+    result = {"intra_op_threads":config["intra_op_threads"], 
+              "inter_op_threads":config["inter_op_threads"],
+              "TF_ENABLE_ONEDNN_OPTS":config["TF_ENABLE_ONEDNN_OPTS"]}
+    # learning step
+    learn_time = {}
+    for batch_size in config["batch_sizes"]:
+        for _ in range(2):
+            agent.learn_replayed(agent.memory.sample_batch(batch_size)) # warm up
+        start = time.perf_counter()
+        for _ in range(config["n_steps"]):
+            agent.learn_replayed(agent.memory.sample_batch(batch_size))
+        learn_time[str(batch_size)] = (time.perf_counter()-start)/config["n_steps"]
+    result["learn_time"] = learn_time
+    
+    # single state action as in the training loop
+    state = rng.normal(size = (1,state_size,1))
+    agent.take_action(state, [])
+    start = time.perf_counter()
+    for _ in range(config["n_steps"]):
+        agent.take_action(state, [])
+    result["act_time"] = (time.perf_counter()-start)/config["n_steps"]
+    
+    # batched actor inference, i.e. the rollout width of evaluation and backtesting
+    infer_time = {}
+    for width in config["rollout_widths"]:
+        states_ts = rng.normal(size = (width,agent.stateTS_size,1)).astype(np.float32)
+        states_ut = rng.normal(size = (width,agent.stateUT_size)).astype(np.float32)
+        agent.actor_local.model([states_ts, states_ut], training = False)
+        start = time.perf_counter()
+        for _ in range(config["n_steps"]):
+            agent.actor_local.model([states_ts, states_ut], training = False)
+        infer_time[str(width)] = (time.perf_counter()-start)/config["n_steps"]
+    result["infer_time"] = infer_time
+    os.chdir(os.path.dirname(work_dir))
+    shutil.rmtree(work_dir)
+    return result
+
+
+class AutoTuner:
+    '''
+    Finds the best tensorflow threading and oneDNN setting, learner batch size 
+    and rollout width (states per actor inference call) for the current 
+    machine through short calibration benchmarks of Agent.learn_replayed and 
+    the actor inference. Every thread setting is benchmarked in a fresh 
+    interpreter. 
+    
+    The thread setting minimizing the time of a training step (one action and
+    one learning step at the batch size of the agent parameters) is selected,
+    the batch size and rollout width are the smallest candidates reaching 
+    saturation times the best throughput. The result is saved as machine 
+    profile, whose thread settings are applied with apply_machineProfile() and 
+    which is used for batch_size = "auto" in the agent parameters and the default 
+    chunk size of the MonteCarloStress.
+    
+    Command line:
+        python tuning.py autotune TEST/agent_parameters.json
+    '''
+    def __init__(self, agentParams: dict, thread_candidates = None, onednn_candidates = ["0","1"],
+                 batch_sizes = [32, 64, 128, 256, 512, 1024], rollout_widths = [1, 16, 64, 256, 1024, 4096],
+                 n_steps = 10, saturation = 0.9):
+        self.agentParams = {key: value for key, value in agentParams.items() if not isinstance(value, np.ndarray)}
+        if self.agentParams.get("batch_size", "auto") == "auto":
+            self.agentParams["batch_size"] = 128
+        if thread_candidates is None:
+            n_cpu = os.cpu_count()
+            intra = sorted(set([2**i for i in range(int(math.log2(n_cpu))+1)]+[n_cpu]))
+            thread_candidates = [[i, j] for i in intra for j in [1,2] if i*j <= max(n_cpu,2)]
+        self.thread_candidates = thread_candidates
+        self.onednn_candidates = onednn_candidates
+        self.batch_sizes = sorted(set(batch_sizes+[self.agentParams["batch_size"]]))
+        self.rollout_widths = rollout_widths
+        self.n_steps = n_steps
+        self.saturation = saturation
+        self.results = []
+    
+    def _calibrate(self, intra: int, inter: int, onednn: str) -> dict:
+        config = {"agentParams":self.agentParams,
+                  "batch_size":self.agentParams["batch_size"],
+                  "batch_sizes":self.batch_sizes,
+                  "rollout_widths":self.rollout_widths,
+                  "n_steps":self.n_steps,
+                  "intra_op_threads":intra,
+                  "inter_op_threads":inter,
+                  "TF_ENABLE_ONEDNN_OPTS":onednn}
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, TF_ENABLE_ONEDNN_OPTS = onednn, AE4350_IGNORE_PROFILE = "1",
+                   PYTHONPATH = os.pathsep.join([module_dir]+[p for p in [os.environ.get("PYTHONPATH")] if p]))
+        code = "import sys, json, tuning; print('CALIBRATION '+json.dumps(tuning._run_calibration(json.loads(sys.stdin.read()))))"
+        process = subprocess.run([sys.executable, "-c", code], input = json.dumps(config), 
+                                 capture_output = True, text = True, env = env)
+        for line in process.stdout.splitlines():
+            if line.startswith("CALIBRATION "):
+                return json.loads(line[len("CALIBRATION "):])
+        raise Exception("Calibration of threads {0}/{1} and oneDNN {2} failed:\n{3}".format(intra, inter, onednn, 
+                                                                                           process.stderr[-2000:]))
+    
+    def run(self) -> pd.DataFrame:
+        '''
+        Benchmarks all candidate settings, returns one row per setting
+        '''
+        self.results = []
+        for onednn in self.onednn_candidates:
+            for intra, inter in self.thread_candidates:
+                result = self._calibrate(intra, inter, onednn)
+                result["step_time"] = result["act_time"]+result["learn_time"][str(self.agentParams["batch_size"])]
+                self.results.append(result)
+                print("Calibrated threads {0}/{1} | oneDNN {2} | training step {3} ms".format(intra, inter, onednn,
+                                                                                             round(1000*result["step_time"],2)))
+        return pd.DataFrame([{key: value for key, value in result.items() if not isinstance(value, dict)} 
+                             for result in self.results])
+    
+    def _saturated(self, times: dict):
+        '''
+        Smallest size whose throughput reaches saturation times the best
+        '''
+        throughput = {int(size): int(size)/times[size] for size in times}
+        best = max(throughput.values())
+        return min(size for size in throughput if throughput[size] >= self.saturation*best)
+    
+    def get_profile(self) -> dict:
+        if not self.results:
+            self.run()
+        best = min(self.results, key = lambda result: result["step_time"])
+        return {"machine":get_machineInfo(),
+                "created":time.strftime("%Y-%m-%d %H:%M:%S"),
+                "TF_ENABLE_ONEDNN_OPTS":best["TF_ENABLE_ONEDNN_OPTS"],
+                "intra_op_threads":best["intra_op_threads"],
+                "inter_op_threads":best["inter_op_threads"],
+                "batch_size":self._saturated(best["learn_time"]),
+                "rollout_width":self._saturated(best["infer_time"]),
+                "results":self.results}
+    
+    def save(self, path = None) -> dict:
+        '''
+        Runs the calibration if required and saves the machine profile
+        '''
+        if path is None:
+            path = MACHINE_PROFILE
+        profile = self.get_profile()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        with open(path, 'w') as fp:
+            json.dump(profile, fp, indent = 1)
+        print("Succesfully saved machine profile to {0} (threads {1}/{2} | oneDNN {3} | batch size {4} | rollout width {5})".format(path,
+                                                                                   profile["intra_op_threads"],
+                                                                                   profile["inter_op_threads"],
+                                                                                   profile["TF_ENABLE_ONEDNN_OPTS"],
+                                                                                   profile["batch_size"],
+                                                                                   profile["rollout_width"]))
+        return profile
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "autotune":
+        with open(sys.argv[2], 'r') as fp:
+            AutoTuner(json.load(fp)).save(sys.argv[3] if len(sys.argv) > 3 else None)
+    else:
+        print("usage: python tuning.py autotune <agent_parameters.json> [profile path]")